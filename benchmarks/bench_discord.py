@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the Discord protocol module.
+
+This builds synthetic guilds (see synthetic.py) and times the protocol's hot paths against a stubbed
+REST layer, without connecting to Discord. Results are written as JSON so that they can be compared
+across commits:
+
+    ./bench_discord.py --output before.json
+    (make changes)
+    ./bench_discord.py --output after.json --compare before.json
+"""
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import collections
+import copy
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import urllib.parse
+
+import gevent
+import requests
+from disco.gateway.events import GatewayEvent
+
+from pylinkirc import conf, utils, world
+from pylinkirc.classes import User
+from pylinkirc.log import log
+
+import synthetic
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+NETNAME = 'discord-bench'
+
+def load_protocol_module():
+    """Imports protocols/discord.py from this checkout."""
+    spec = importlib.util.spec_from_file_location('pylinkirc.protocols.discord',
+                                                  os.path.join(REPO_DIR, 'protocols', 'discord.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+discord = load_protocol_module()
+
+class StubTransport(requests.adapters.BaseAdapter):
+    """
+    requests transport adapter that answers the Discord REST calls used by the protocol module locally,
+    with an optional fixed latency per call.
+    """
+    def __init__(self, latency=0):
+        super().__init__()
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.lines_delivered = 0
+        # Text of each message sent
+        self.delivered = []
+        self._snowflake = synthetic.SnowflakeGenerator()
+
+    def send(self, request, **kwargs):
+        path = urllib.parse.urlparse(request.url).path.split('/api', 1)[-1]
+        path = path[path.index('/', 1):] if path.startswith('/v') else path
+        parts = path.strip('/').split('/')
+        self.calls[(request.method, discord.PyLinkDiscordProtocol._get_route_name(request.url))] += 1
+        if self.latency:
+            gevent.sleep(self.latency)
+
+        status, body = 200, None
+        if request.method == 'POST' and parts[0] == 'channels' and parts[2] == 'messages':
+            self._count_lines(request)
+            body = {'id': str(self._snowflake()), 'channel_id': parts[1], 'content': '',
+                    'author': {'id': '1', 'username': 'PyLink', 'discriminator': '0000'},
+                    'timestamp': synthetic.JOINED_AT, 'attachments': [], 'embeds': [], 'mentions': []}
+        elif parts[0] == 'channels' and parts[2] == 'webhooks':
+            if request.method == 'GET':
+                body = []
+            else:
+                name = json.loads(request.body)['name']
+                body = {'id': str(self._snowflake()), 'token': 'stubtoken', 'name': name, 'channel_id': parts[1]}
+        elif request.method == 'POST' and parts[0] == 'webhooks':
+            self._count_lines(request)
+            status = 204
+        elif request.method == 'POST' and path == '/users/@me/channels':
+            body = {'id': str(self._snowflake()), 'type': 1, 'recipients': []}
+        else:
+            status, body = 404, {'code': 0, 'message': 'Not stubbed'}
+
+        response = requests.Response()
+        response.status_code = status
+        response.url = request.url
+        response.request = request
+        response.headers['Content-Type'] = 'application/json'
+        response._content = json.dumps(body).encode('utf-8') if body is not None else b''
+        return response
+
+    def _count_lines(self, request):
+        if request.headers.get('Content-Type', '').startswith('multipart/form-data'):
+            # Packed messages: count the lines in the attached file
+            match = re.search(rb'filename="[^"]*"\r\n(?:[^\r\n]+\r\n)*\r\n(.*?)\r\n--', request.body, re.S)
+            text = match.group(1).decode('utf-8', 'replace') if match else ''
+        else:
+            data = json.loads(request.body)
+            embeds = data.get('embeds') or ([data['embed']] if data.get('embed') else [])
+            if embeds:
+                text = '\n'.join(embed.get('description') or '' for embed in embeds)
+            else:
+                text = data.get('content') or ''
+        self.delivered.append(text)
+        self.lines_delivered += text.count('\n') + 1 if text else 0
+
+    def close(self):
+        pass
+
+class BenchNetwork:
+    """A PyLinkDiscordProtocol instance with one synthetic guild and a stubbed REST layer."""
+    def __init__(self, member_count, seed=0, **serverdata):
+        self.rng = random.Random(seed)
+        self.guild_payload = synthetic.make_guild(member_count, seed=seed)
+
+        conf.conf['servers'][NETNAME] = dict({'protocol': 'discord', 'token': 'benchmark'}, **serverdata)
+        self.proto = discord.PyLinkDiscordProtocol(NETNAME)
+        self.transport = StubTransport()
+        for prefix in ('https://', 'http://'):
+            self.proto.client.api.http.session.mount(prefix, self.transport)
+
+        self.client = self.proto.client
+        self.plugin = self.proto.bot_plugin
+        event = self.dispatch('GUILD_CREATE', self.guild_payload)
+        self.client.state.on_guild_create(event)
+        self.guild = event.guild
+        self.plugin.me = self.client.state.users[int(self.guild_payload['members'][0]['user']['id'])]
+
+    def dispatch(self, event_type, payload):
+        """Returns a disco gateway event object for the given payload (which is copied first)."""
+        return GatewayEvent.from_dispatch(self.client, {'t': event_type, 'd': copy.deepcopy(payload)})
+
+    def burst(self):
+        if self.guild.id in self.proto._children:
+            self.proto._remove_child(self.guild.id)
+        self.plugin._burst_guild(self.guild)
+        return self.proto._children[self.guild.id]
+
+    def shutdown(self):
+        self.proto._aborted.set()
+        if self.guild.id in self.proto._children:
+            self.proto._remove_child(self.guild.id)
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def bench_burst(net, events):
+    return timed(net.burst), 1
+
+def bench_member_update(net, events):
+    net.burst()
+    members = net.guild_payload['members'][1:]
+    prepared = [net.dispatch('GUILD_MEMBER_UPDATE', synthetic.member_update(net.guild_payload, net.rng.choice(members), net.rng))
+                for _ in range(events)]
+
+    def run():
+        for event in prepared:
+            net.plugin.on_member_update(event)
+    return timed(run), len(prepared)
+
+def bench_channel_update(net, events):
+    net.burst()
+    channels = synthetic.text_channels(net.guild_payload)
+    prepared = [net.dispatch('CHANNEL_UPDATE', synthetic.channel_update(net.guild_payload, net.rng.choice(channels), net.rng))
+                for _ in range(events)]
+
+    def run():
+        for event in prepared:
+            net.plugin.on_channel_update(event)
+    return timed(run), len(prepared)
+
+def bench_presence_storm(net, events):
+    net.burst()
+    members = net.guild_payload['members'][1:]
+    prepared = [net.dispatch('PRESENCE_UPDATE', synthetic.presence_update(net.guild_payload, net.rng.choice(members), net.rng))
+                for _ in range(events * 10)]
+
+    def run():
+        for event in prepared:
+            net.plugin.on_presence_update(event)
+    return timed(run), len(prepared)
+
+def _bench_message_builder(net, events, use_webhooks):
+    child = net.burst()
+    channels = synthetic.text_channels(net.guild_payload)[:10]
+
+    # Fake a few relay users, as relay would introduce them
+    senders = []
+    for idx in range(20):
+        uid = '%d@bench' % idx
+        user = child.users[uid] = User(child, nick='ircuser%d' % idx, ts=int(time.time()), uid=uid,
+                                       server=child.sid)
+        user.remote = (child.name, uid)
+        senders.append(uid)
+
+    net.proto._aborted.clear()
+    net.proto._message_thread = gevent.spawn(net.proto._message_builder)
+
+    start = time.perf_counter()
+    for idx in range(events):
+        source = net.rng.choice(senders) if use_webhooks else child.pseudoclient.uid
+        child.message(source, int(net.rng.choice(channels)), 'benchmark message %d with some text' % idx)
+
+    deadline = time.monotonic() + 120
+    while net.transport.lines_delivered < events and time.monotonic() < deadline:
+        gevent.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    net.proto._aborted.set()
+    net.proto._message_thread.join()
+    return elapsed, net.transport.lines_delivered
+
+def bench_message_builder(net, events):
+    return _bench_message_builder(net, events, use_webhooks=False)
+
+def bench_message_builder_webhooks(net, events):
+    return _bench_message_builder(net, events, use_webhooks=True)
+
+def bench_message_builder_packed(net, events):
+    return _bench_message_builder(net, events, use_webhooks=False)
+
+def _bench_formatting(func, make_line, events):
+    rng = random.Random(0)
+    lines = [make_line(rng) for _ in range(events * 10)]
+
+    def run():
+        for line in lines:
+            func(line)
+    return timed(run), len(lines)
+
+def _old_irc_to_discord(text):
+    """The outgoing formatting chain used before irc_to_discord()."""
+    text = utils.strip_irc_formatting(text)
+    text = text.replace('@here', '@ here')
+    return text.replace('@everyone', '@ everyone')
+
+def bench_format_outbound_old(net, events):
+    return _bench_formatting(_old_irc_to_discord, synthetic.irc_line, events)
+
+def bench_format_outbound(net, events):
+    return _bench_formatting(discord.irc_to_discord, synthetic.irc_line, events)
+
+def bench_format_inbound_old(net, events):
+    # Incoming messages used to be split into lines without any formatting changes
+    return _bench_formatting(lambda text: text.split('\n'), synthetic.markdown_line, events)
+
+def bench_format_inbound(net, events):
+    return _bench_formatting(lambda text: discord.discord_to_irc(text).split('\n'), synthetic.markdown_line, events)
+
+def _bench_mentions(net, events, render):
+    rng = random.Random(0)
+    members = net.guild_payload['members'][1:]
+    channels = synthetic.text_channels(net.guild_payload)
+    messages = []
+    for idx in range(events * 10):
+        # Most lines in a channel don't mention anyone
+        content = synthetic.mention_content(net.guild_payload, rng) if rng.random() < 0.3 else \
+            ' '.join(rng.choices(synthetic.WORDS, k=rng.randint(3, 12)))
+        payload = synthetic.message_create(net.guild_payload, rng.choice(channels), rng.choice(members),
+                                           content, 10 ** 15 + idx)
+        payload['mentions'] = [member['user'] for member in members
+                               if member['user']['id'] in content]
+        messages.append(net.dispatch('MESSAGE_CREATE', payload).message)
+
+    def run():
+        for message in messages:
+            render(message)
+    return timed(run), len(messages)
+
+def _old_render_mentions(message):
+    """The mention rendering used by on_message before MentionRenderer."""
+    def format_user_mentions(u):
+        if message.guild and u.id in message.guild.members:
+            return '@' + message.guild.members[u.id].name
+        else:
+            return '@' + str(u)
+    return message.replace_mentions(user_replace=format_user_mentions,
+                                    role_replace=lambda r: '@' + str(r),
+                                    channel_replace=str)
+
+def bench_render_mentions_old(net, events):
+    return _bench_mentions(net, events, _old_render_mentions)
+
+def bench_render_mentions(net, events):
+    renderer = net.burst().mention_renderer
+    return _bench_mentions(net, events, renderer.render)
+
+# Benchmarks with 'standalone' set don't use a network, and only run once regardless of --sizes
+BENCHMARKS = collections.OrderedDict([
+    ('burst_guild', (bench_burst, {})),
+    ('member_update', (bench_member_update, {})),
+    ('channel_update', (bench_channel_update, {})),
+    ('presence_storm', (bench_presence_storm, {})),
+    ('message_builder', (bench_message_builder, {})),
+    ('message_builder_webhooks', (bench_message_builder_webhooks, {'use_webhooks': True})),
+    ('message_builder_packed', (bench_message_builder_packed, {'pack_messages': True})),
+    ('render_mentions_old', (bench_render_mentions_old, {})),
+    ('render_mentions', (bench_render_mentions, {})),
+    ('format_outbound_old', (bench_format_outbound_old, {'standalone': True})),
+    ('format_outbound', (bench_format_outbound, {'standalone': True})),
+    ('format_inbound_old', (bench_format_inbound_old, {'standalone': True})),
+    ('format_inbound', (bench_format_inbound, {'standalone': True})),
+])
+
+# --events and --repeat apply as given to guilds of up to this many members, and are scaled down for bigger ones
+BASE_SIZE = 1000
+MIN_EVENTS = 20
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_one(name, size, events, repeat):
+    func, options = BENCHMARKS[name]
+    best = None
+    for attempt in range(repeat):
+        if options.get('standalone'):
+            net = None
+            elapsed, ops = func(net, events)
+            rest_calls = 0
+        else:
+            net = BenchNetwork(size, seed=attempt, **options)
+            try:
+                elapsed, ops = func(net, events)
+            finally:
+                net.shutdown()
+            rest_calls = sum(net.transport.calls.values())
+        if best is None or elapsed < best[0]:
+            best = (elapsed, ops, rest_calls)
+    elapsed, ops, rest_calls = best
+    result = {
+        'name': name,
+        'members': size,
+        'ops': ops,
+        'seconds': elapsed,
+        'ops_per_second': ops / elapsed if elapsed else None,
+        'rest_calls': rest_calls,
+    }
+    print('%-26s members=%-7d ops=%-6d %10.4f s %12.1f ops/s  rest_calls=%d' % (
+          name, size, ops, elapsed, result['ops_per_second'] or 0, rest_calls))
+    return result
+
+def scale_for_size(size, events, repeat):
+    """
+    Returns the (events, repeat) to use for a guild with the given member count. events and repeat apply
+    to guilds of up to BASE_SIZE members; bigger guilds get proportionally fewer events and a single run,
+    since bursting and updating them takes much longer.
+    """
+    if size <= BASE_SIZE:
+        return events, repeat
+    return max(MIN_EVENTS, events * BASE_SIZE // size), 1
+
+def run(sizes, names, events, repeat):
+    results = []
+    for size in sizes:
+        size_events, size_repeat = scale_for_size(size, events, repeat)
+        for name in names:
+            if not BENCHMARKS[name][1].get('standalone'):
+                results.append(run_one(name, size, size_events, size_repeat))
+    for name in names:
+        if BENCHMARKS[name][1].get('standalone'):
+            results.append(run_one(name, 0, events, repeat))
+    return results
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {(r['name'], r['members']): r for r in json.load(f)['results']}
+    print('\nComparison against %s:' % baseline_file)
+    for result in results:
+        old = baseline.get((result['name'], result['members']))
+        if old and old['seconds'] and result['ops'] == old['ops']:
+            print('%-26s members=%-7d %+7.1f%%' % (result['name'], result['members'],
+                                                  (result['seconds'] / old['seconds'] - 1) * 100))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='comma separated list of guild member counts (default: %(default)s)')
+    parser.add_argument('--only', help='comma separated list of benchmarks to run (default: all of %s)' %
+                        ', '.join(BENCHMARKS))
+    parser.add_argument('--events', type=int, default=1000,
+                        help='events or messages per benchmark, for guilds of up to %d members; bigger guilds '
+                             'use proportionally fewer (default: %%(default)s)' % BASE_SIZE)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark, for guilds of up to %d members; the best is kept. Bigger guilds '
+                             'are run once (default: %%(default)s)' % BASE_SIZE)
+    parser.add_argument('--output', default='bench_results.json', help='where to write results (default: %(default)s)')
+    parser.add_argument('--compare', help='results file from an earlier run to compare against')
+    args = parser.parse_args()
+
+    log.setLevel(logging.WARNING)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+
+    results = run(sizes, names, args.events, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': get_commit(),
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'results': results,
+        }, f, indent=2)
+    print('Wrote results to %s' % args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
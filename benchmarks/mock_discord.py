@@ -0,0 +1,399 @@
+"""
+Local stand-in for the Discord gateway and REST API, for load testing the protocol module end to end.
+
+MockDiscord speaks just enough of the gateway websocket protocol (HELLO, IDENTIFY, heartbeats, READY,
+GUILD_CREATE, member chunks and arbitrary dispatches) and serves the REST endpoints used by
+protocols/discord.py: sending messages, listing/creating/executing webhooks, opening DMs, and looking up
+the current user and its guilds. Extra bot accounts can be added by token with add_sender().
+REST routes are rate limited per channel/webhook (and per bot account for channels) like on Discord,
+including rate limit headers and 429s.
+
+This needs a gevent-patched process (it is normally driven by replay.py).
+"""
+
+import base64
+import collections
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import time
+import urllib.parse
+import zlib
+
+import gevent
+import gevent.event
+from gevent.pywsgi import WSGIServer
+from gevent.server import StreamServer
+
+import synthetic
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OP_DISPATCH, OP_HEARTBEAT, OP_IDENTIFY, OP_REQUEST_MEMBERS, OP_HELLO, OP_HEARTBEAT_ACK = 0, 1, 2, 8, 10, 11
+WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG = 0x1, 0x2, 0x8, 0x9, 0xA
+
+# Matches trace markers ("[#123]") that replay.py embeds in messages to measure latency
+MARKER_RE = re.compile(r'\[#(\d+)\]')
+
+class WebsocketConnection:
+    """Minimal server side websocket implementation (RFC 6455) on top of a gevent socket."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+        self.closed = False
+        self.query = {}
+
+    def handshake(self):
+        request_line = self.rfile.readline().decode('latin-1')
+        headers = {}
+        while True:
+            line = self.rfile.readline().decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        path = request_line.split(' ')[1] if ' ' in request_line else '/'
+        self.query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(path).query))
+        accept = base64.b64encode(hashlib.sha1(headers['sec-websocket-key'].encode() + WEBSOCKET_GUID).digest())
+        self.sock.sendall(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                          b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+    def send_frame(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([length])
+        elif length < 1 << 16:
+            header += bytes([126]) + struct.pack('>H', length)
+        else:
+            header += bytes([127]) + struct.pack('>Q', length)
+        self.sock.sendall(header + payload)
+
+    def _read(self, size):
+        data = self.rfile.read(size)
+        if len(data) < size:
+            raise ConnectionError('websocket closed')
+        return data
+
+    def recv_frame(self):
+        """Returns the next (opcode, payload) pair sent by the client."""
+        first, second = self._read(2)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack('>H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('>Q', self._read(8))[0]
+        mask = self._read(4) if second & 0x80 else None
+        payload = self._read(length)
+        if mask:
+            payload = bytes(byte ^ mask[idx % 4] for idx, byte in enumerate(payload))
+        return opcode, payload
+
+    def close(self, code=1000):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.send_frame(WS_CLOSE, struct.pack('>H', code))
+            except OSError:
+                pass
+            self.sock.close()
+
+class GatewaySession:
+    """One gateway connection from a client."""
+    def __init__(self, server, ws):
+        self.server = server
+        self.ws = ws
+        self.seq = 0
+        self.identified = gevent.event.Event()
+        self._zlib = zlib.compressobj() if ws.query.get('compress') == 'zlib-stream' else None
+
+    def send(self, payload):
+        data = json.dumps(payload).encode('utf-8')
+        if self._zlib:
+            data = self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+            self.ws.send_frame(WS_BINARY, data)
+        else:
+            self.ws.send_frame(WS_TEXT, data)
+
+    def dispatch(self, event_type, data):
+        self.seq += 1
+        self.send({'op': OP_DISPATCH, 't': event_type, 's': self.seq, 'd': data})
+
+    def run(self):
+        self.send({'op': OP_HELLO, 's': None, 't': None, 'd': {'heartbeat_interval': 41250}})
+        while not self.ws.closed:
+            try:
+                opcode, payload = self.ws.recv_frame()
+            except (ConnectionError, OSError):
+                break
+            if opcode == WS_CLOSE:
+                break
+            elif opcode == WS_PING:
+                self.ws.send_frame(WS_PONG, payload)
+                continue
+            elif opcode not in (WS_TEXT, WS_BINARY):
+                continue
+            self.handle(json.loads(payload.decode('utf-8')))
+        self.ws.close()
+        self.server.sessions.discard(self)
+
+    def handle(self, packet):
+        op = packet['op']
+        if op == OP_HEARTBEAT:
+            self.send({'op': OP_HEARTBEAT_ACK, 's': None, 't': None, 'd': None})
+        elif op == OP_IDENTIFY:
+            self.dispatch('READY', {
+                'v': 6,
+                'user': self.server.bot_user,
+                'session_id': 'mock%d' % random.randrange(1 << 32),
+                'guilds': [{'id': guild['id'], 'unavailable': True} for guild in self.server.guilds],
+                'private_channels': [],
+                '_trace': ['mock-discord'],
+            })
+            for guild in self.server.guilds:
+                self.dispatch('GUILD_CREATE', guild)
+            self.identified.set()
+        elif op == OP_REQUEST_MEMBERS:
+            guild = self.server.get_guild(packet['d']['guild_id'])
+            if guild:
+                members = guild['members']
+                for offset in range(0, len(members), 1000):
+                    self.dispatch('GUILD_MEMBERS_CHUNK', {'guild_id': guild['id'], 'members': members[offset:offset + 1000]})
+
+class RateLimiter:
+    """Per-bucket fixed window rate limiter, reporting Discord style headers."""
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.buckets = {}
+
+    def hit(self, bucket):
+        """Returns (allowed, headers) for a request to the given bucket."""
+        now = time.time()
+        reset, remaining = self.buckets.get(bucket, (now + self.window, self.limit))
+        if now >= reset:
+            reset, remaining = now + self.window, self.limit
+
+        allowed = remaining > 0
+        if allowed:
+            remaining -= 1
+        self.buckets[bucket] = (reset, remaining)
+        headers = [
+            ('X-RateLimit-Limit', str(self.limit)),
+            ('X-RateLimit-Remaining', str(remaining)),
+            ('X-RateLimit-Reset', str(math.ceil(reset))),
+            ('X-RateLimit-Reset-After', '%.3f' % (reset - now)),
+            ('X-RateLimit-Bucket', hashlib.md5(bucket.encode()).hexdigest()[:12]),
+        ]
+        if not allowed:
+            headers.append(('Retry-After', str(math.ceil(reset - now))))
+        return allowed, headers, reset - now
+
+class MockDiscord:
+    """
+    Mock Discord gateway and REST API.
+
+    guilds: a list of GUILD_CREATE payloads (see synthetic.make_guild) to send on IDENTIFY
+    bot_user: the user payload for the bot account
+    ratelimit: (requests, seconds) allowed per channel or webhook, or None to disable rate limiting
+    latency: fixed delay added to each REST response, in seconds
+
+    Requests with an unknown token are treated as coming from bot_user.
+    """
+    def __init__(self, guilds, bot_user, host='127.0.0.1', ratelimit=(5, 5), latency=0):
+        self.guilds = guilds
+        self.bot_user = bot_user
+        self.host = host
+        self.latency = latency
+        self.limiter = RateLimiter(*ratelimit) if ratelimit else None
+        self.sessions = set()
+        self.webhooks = {}
+        # token -> user payload of extra bot accounts
+        self.senders = {}
+        self.snowflake = synthetic.SnowflakeGenerator()
+
+        # marker -> time the message was received over REST
+        self.received = {}
+        self.stats = collections.Counter()
+        self.on_rest_message = None
+
+        self.rest_server = WSGIServer((host, 0), self.rest_app, log=None)
+        self.gateway_server = StreamServer((host, 0), self.handle_gateway)
+
+    @property
+    def api_base_url(self):
+        return 'http://%s:%d/api/v7' % (self.host, self.rest_server.server_port)
+
+    @property
+    def gateway_url(self):
+        return 'ws://%s:%d' % (self.host, self.gateway_server.server_port)
+
+    def start(self):
+        self.rest_server.start()
+        self.gateway_server.start()
+
+    def stop(self):
+        for session in list(self.sessions):
+            session.ws.close()
+        self.rest_server.stop()
+        self.gateway_server.stop()
+
+    def add_sender(self, token, user):
+        """Adds an extra bot account using the given token, which is in all guilds."""
+        self.senders[token] = user
+
+    def _get_user(self, environ):
+        """Returns the user payload for the token a REST request was made with."""
+        token = environ.get('HTTP_AUTHORIZATION', '').split(' ', 1)[-1]
+        return self.senders.get(token, self.bot_user)
+
+    def get_guild(self, guild_id):
+        return next((guild for guild in self.guilds if guild['id'] == str(guild_id)), None)
+
+    def handle_gateway(self, sock, address):
+        ws = WebsocketConnection(sock)
+        try:
+            ws.handshake()
+        except (KeyError, OSError):
+            sock.close()
+            return
+        session = GatewaySession(self, ws)
+        self.sessions.add(session)
+        session.run()
+
+    def dispatch(self, event_type, data):
+        """Sends a dispatch event to all identified gateway sessions."""
+        for session in list(self.sessions):
+            if session.identified.is_set():
+                session.dispatch(event_type, data)
+
+    def wait_identified(self, timeout=None):
+        deadline = time.monotonic() + (timeout or 1e9)
+        while not any(session.identified.is_set() for session in self.sessions):
+            if time.monotonic() > deadline:
+                return False
+            gevent.sleep(0.05)
+        return True
+
+    def _record_content(self, content):
+        now = time.perf_counter()
+        for marker in MARKER_RE.findall(content or ''):
+            self.received.setdefault(int(marker), now)
+        if self.on_rest_message:
+            self.on_rest_message(content)
+
+    def rest_app(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ['PATH_INFO'].split('/api', 1)[-1]
+        if re.match(r'/v\d+/', path):
+            path = path[path.index('/', 1):]
+        parts = path.strip('/').split('/')
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length) if length else b''
+        self.stats['requests'] += 1
+
+        if self.latency:
+            gevent.sleep(self.latency)
+
+        # Rate limit per major resource, like Discord does
+        headers = [('Content-Type', 'application/json')]
+        if self.limiter and method != 'GET':
+            bucket = '%s %s' % (method, '/'.join(parts[:2]))
+            if parts[0] == 'channels':  # Channel rate limits are per bot account, unlike webhooks
+                bucket = '%s %s' % (self._get_user(environ)['id'], bucket)
+            allowed, limit_headers, retry_after = self.limiter.hit(bucket)
+            headers += limit_headers
+            if not allowed:
+                self.stats['ratelimited'] += 1
+                start_response('429 Too Many Requests', headers)
+                return [json.dumps({'message': 'You are being rate limited.', 'global': False,
+                                    'retry_after': int(retry_after * 1000)}).encode()]
+
+        status, response = self.route(method, parts, body, environ)
+        if status == 204:
+            start_response('204 No Content', headers)
+            return [b'']
+        start_response('%d %s' % (status, 'OK' if status < 400 else 'Error'), headers)
+        return [json.dumps(response).encode('utf-8')]
+
+    def _parse_body(self, body, environ):
+        content_type = environ.get('CONTENT_TYPE', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body.decode('utf-8') or '{}')
+        elif content_type.startswith('multipart/form-data'):
+            # Only payload_json/content fields and text attachments matter here
+            text = body.decode('utf-8', 'replace')
+            match = re.search(r'name="payload_json"\r\n\r\n(.*?)\r\n--', text, re.S)
+            if match:
+                data = json.loads(match.group(1))
+            else:
+                match = re.search(r'name="content"\r\n\r\n(.*?)\r\n--', text, re.S)
+                data = {'content': match.group(1) if match else ''}
+            data['files'] = re.findall(r'filename="[^"]*"\r\n(?:[^\r\n]+\r\n)*\r\n(.*?)\r\n--', text, re.S)
+            return data
+        return dict(urllib.parse.parse_qsl(body.decode('utf-8')))
+
+    @staticmethod
+    def _message_text(data):
+        """Returns all text in a message payload: content, embed descriptions and attached files."""
+        embeds = data.get('embeds') or ([data['embed']] if data.get('embed') else [])
+        parts = [data.get('content') or ''] + [embed.get('description') or '' for embed in embeds]
+        return '\n'.join(parts + data.get('files', []))
+
+    def route(self, method, parts, body, environ):
+        if parts == ['gateway'] or parts == ['gateway', 'bot']:
+            return 200, {'url': self.gateway_url, 'shards': 1}
+
+        elif parts[0] == 'channels' and len(parts) == 3 and parts[2] == 'messages' and method == 'POST':
+            data = self._parse_body(body, environ)
+            user = self._get_user(environ)
+            self.stats['messages'] += 1
+            if user is not self.bot_user:
+                self.stats['messages_%s' % user['username']] += 1
+            self._record_content(self._message_text(data))
+            return 200, self._message(parts[1], data.get('content', ''), user)
+
+        elif parts[0] == 'channels' and len(parts) == 3 and parts[2] == 'webhooks':
+            if method == 'GET':
+                return 200, [wh for wh in self.webhooks.values() if wh['channel_id'] == parts[1]]
+            data = self._parse_body(body, environ)
+            webhook_id = str(self.snowflake())
+            webhook = self.webhooks[webhook_id] = {'id': webhook_id, 'token': 'token%s' % webhook_id,
+                                                   'name': data.get('name'), 'channel_id': parts[1]}
+            return 200, webhook
+
+        elif parts[0] == 'webhooks' and len(parts) == 3 and method == 'POST':
+            webhook = self.webhooks.get(parts[1])
+            if not webhook or webhook['token'] != parts[2]:
+                return 404, {'code': 10015, 'message': 'Unknown Webhook'}
+            data = self._parse_body(body, environ)
+            self.stats['webhook_messages'] += 1
+            self._record_content(self._message_text(data))
+            return 204, None
+
+        elif parts == ['users', '@me', 'channels'] and method == 'POST':
+            data = self._parse_body(body, environ)
+            return 200, {'id': str(self.snowflake()), 'type': 1,
+                         'recipients': [{'id': str(data.get('recipient_id')), 'username': 'dmuser',
+                                         'discriminator': '0000'}]}
+
+        elif parts == ['users', '@me']:
+            return 200, self._get_user(environ)
+
+        elif parts == ['users', '@me', 'guilds']:
+            params = dict(urllib.parse.parse_qsl(environ.get('QUERY_STRING', '')))
+            guilds = [{'id': guild['id'], 'name': guild['name'], 'owner': False, 'permissions': 0}
+                      for guild in self.guilds if int(guild['id']) > int(params.get('after', 0))]
+            return 200, guilds[:int(params.get('limit', 200))]
+
+        return 404, {'code': 0, 'message': '404: Not Found'}
+
+    def _message(self, channel_id, content, author):
+        return {'id': str(self.snowflake()), 'channel_id': str(channel_id), 'content': content, 'author': author,
+                'timestamp': synthetic.JOINED_AT, 'edited_timestamp': None, 'tts': False,
+                'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [],
+                'embeds': [], 'pinned': False, 'type': 0}
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+End-to-end load replay against a local Discord stand-in (see mock_discord.py).
+
+This runs the real PyLinkDiscordProtocol.connect() path against MockDiscord, replays a recorded or
+generated gateway event trace at a configurable rate while sending IRC-side messages through the
+protocol, and reports latency from Discord event to PyLink hook and from IRC message to REST call.
+
+    ./replay.py --members 5000 --rate 50 --irc-rate 20 --duration 30 --webhooks
+    ./replay.py --record trace.jsonl --duration 10    # save the generated trace
+    ./replay.py --trace trace.jsonl --speed 4         # replay it 4x as fast
+"""
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import json
+import logging
+import random
+import time
+
+import gevent
+
+from pylinkirc import conf, utils, world
+from pylinkirc.classes import User
+from pylinkirc.log import log
+
+import synthetic
+from bench_discord import discord, get_commit
+from mock_discord import MARKER_RE, MockDiscord
+
+NETNAME = 'discord-replay'
+# Markers for IRC -> Discord messages start here, so they don't collide with inbound ones
+OUTBOUND_MARKER_OFFSET = 10 ** 9
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    def pick(fraction):
+        return values[min(len(values) - 1, int(len(values) * fraction))]
+    return {'count': len(values), 'min': values[0], 'p50': pick(0.5), 'p95': pick(0.95),
+            'p99': pick(0.99), 'max': values[-1], 'mean': sum(values) / len(values)}
+
+def generate_trace(guild, rate, duration, presence_ratio, seed=0):
+    """
+    Returns a list of (offset in seconds, event type, payload) tuples: MESSAGE_CREATE events carrying
+    latency markers, mixed with PRESENCE_UPDATE events.
+    """
+    rng = random.Random(seed)
+    members = guild['members'][1:]
+    channels = synthetic.text_channels(guild)
+    trace = []
+    for idx in range(int(rate * duration)):
+        offset = idx / rate
+        member = rng.choice(members)
+        if rng.random() < presence_ratio:
+            trace.append((offset, 'PRESENCE_UPDATE', synthetic.presence_update(guild, member, rng)))
+        else:
+            trace.append((offset, 'MESSAGE_CREATE', synthetic.message_create(
+                guild, rng.choice(channels), member, '[#%d] replayed message %d' % (idx, idx), 10 ** 15 + idx)))
+    return trace
+
+def load_trace(filename):
+    with open(filename) as f:
+        return [(entry['at'], entry['t'], entry['d']) for entry in map(json.loads, f) if entry]
+
+def save_trace(trace, filename):
+    with open(filename, 'w') as f:
+        for offset, event_type, payload in trace:
+            f.write(json.dumps({'at': offset, 't': event_type, 'd': payload}) + '\n')
+
+class Replay:
+    def __init__(self, args):
+        self.args = args
+        self.guild = synthetic.make_guild(args.members, seed=args.seed)
+        self.bot_user = self.guild['members'][0]['user']
+        ratelimit = None
+        if args.ratelimit != 'none':
+            requests, seconds = args.ratelimit.split('/')
+            ratelimit = (int(requests), float(seconds))
+        self.mock = MockDiscord([self.guild], self.bot_user, ratelimit=ratelimit, latency=args.rest_latency)
+        self.sender_tokens = []
+        for idx in range(args.senders):
+            token = 'sender%d' % idx
+            self.mock.add_sender(token, {'id': str(10 ** 17 + idx), 'username': 'PyLinkSender%d' % idx,
+                                         'discriminator': '0000', 'avatar': None, 'bot': True})
+            self.sender_tokens.append(token)
+
+        self.sent_inbound = {}
+        self.hooked_inbound = {}
+        self.sent_outbound = {}
+
+    def on_privmsg(self, irc, source, command, args):
+        now = time.perf_counter()
+        for marker in MARKER_RE.findall(args.get('text', '')):
+            self.hooked_inbound.setdefault(int(marker), now)
+
+    def start(self):
+        self.mock.start()
+        conf.conf['servers'][NETNAME] = {'protocol': 'discord', 'token': 'mock', 'use_webhooks': self.args.webhooks,
+                                         'sender_tokens': self.sender_tokens}
+        self.proto = discord.PyLinkDiscordProtocol(NETNAME)
+        for sender in self.proto.senders:
+            sender.api.http.BASE_URL = self.mock.api_base_url
+        world.networkobjects[NETNAME] = self.proto
+        utils.add_hook(self.on_privmsg, 'PRIVMSG')
+
+        gevent.spawn(self.proto.connect)
+        guild_id = int(self.guild['id'])
+        deadline = time.monotonic() + 120
+        while not (guild_id in self.proto._children and self.proto._children[guild_id].connected.is_set()):
+            if time.monotonic() > deadline:
+                raise RuntimeError('Timed out waiting for the guild to burst')
+            gevent.sleep(0.05)
+        self.child = self.proto._children[guild_id]
+
+    def replay_inbound(self, trace):
+        start = time.perf_counter()
+        for offset, event_type, payload in trace:
+            delay = start + offset / self.args.speed - time.perf_counter()
+            if delay > 0:
+                gevent.sleep(delay)
+            if event_type == 'MESSAGE_CREATE':
+                for marker in MARKER_RE.findall(payload.get('content', '')):
+                    self.sent_inbound[int(marker)] = time.perf_counter()
+            self.mock.dispatch(event_type, payload)
+
+    def send_outbound(self):
+        rng = random.Random(self.args.seed)
+        channels = [int(channel) for channel in synthetic.text_channels(self.guild)[:10]]
+        senders = []
+        for idx in range(20):  # Fake relay users, as relay would introduce them
+            uid = '%d@replay' % idx
+            user = self.child.users[uid] = User(self.child, nick='ircuser%d' % idx, ts=int(time.time()), uid=uid,
+                                                server=self.child.sid)
+            user.remote = (self.child.name, uid)
+            senders.append(uid)
+
+        count = int(self.args.irc_rate * self.args.duration)
+        start = time.perf_counter()
+        for idx in range(count):
+            delay = start + idx / self.args.irc_rate - time.perf_counter()
+            if delay > 0:
+                gevent.sleep(delay)
+            marker = OUTBOUND_MARKER_OFFSET + idx
+            source = rng.choice(senders) if self.args.webhooks else self.child.pseudoclient.uid
+            self.sent_outbound[marker] = time.perf_counter()
+            self.child.message(source, rng.choice(channels), '[#%d] IRC message %d' % (marker, idx))
+
+    def wait_for_drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if len(self.hooked_inbound) >= len(self.sent_inbound) and \
+                    all(marker in self.mock.received for marker in self.sent_outbound):
+                return
+            gevent.sleep(0.1)
+
+    def report(self):
+        inbound = [self.hooked_inbound[m] - sent for m, sent in self.sent_inbound.items() if m in self.hooked_inbound]
+        outbound = [self.mock.received[m] - sent for m, sent in self.sent_outbound.items() if m in self.mock.received]
+        return {
+            'commit': get_commit(),
+            'timestamp': int(time.time()),
+            'options': vars(self.args),
+            'discord_to_hook': dict(percentiles(inbound), lost=len(self.sent_inbound) - len(inbound)),
+            'irc_to_rest': dict(percentiles(outbound), lost=len(self.sent_outbound) - len(outbound)),
+            'mock': dict(self.mock.stats),
+            'metrics': self.proto.metrics.summary(),
+        }
+
+    def stop(self):
+        self.proto.disconnect()
+        self.mock.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--members', type=int, default=1000, help='members in the synthetic guild (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of traffic to generate (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=50, help='gateway events per second (default: %(default)s)')
+    parser.add_argument('--presence-ratio', type=float, default=0.3,
+                        help='fraction of generated events that are presence updates (default: %(default)s)')
+    parser.add_argument('--irc-rate', type=float, default=20, help='IRC messages per second to send (default: %(default)s)')
+    parser.add_argument('--trace', help='replay this trace file instead of generating events')
+    parser.add_argument('--record', help='write the generated trace to this file')
+    parser.add_argument('--speed', type=float, default=1.0, help='trace playback speed multiplier (default: %(default)s)')
+    parser.add_argument('--webhooks', action='store_true', help='send IRC messages through webhooks')
+    parser.add_argument('--ratelimit', default='5/5',
+                        help='REST requests/seconds allowed per channel or webhook, or "none" (default: %(default)s)')
+    parser.add_argument('--senders', type=int, default=0, help='extra sender bot accounts to send with')
+    parser.add_argument('--rest-latency', type=float, default=0.0, help='added latency per REST call in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='replay_results.json', help='where to write results (default: %(default)s)')
+    args = parser.parse_args()
+
+    log.setLevel(logging.WARNING)
+    replay = Replay(args)
+    trace = load_trace(args.trace) if args.trace else \
+        generate_trace(replay.guild, args.rate, args.duration, args.presence_ratio, seed=args.seed)
+    if args.record:
+        save_trace(trace, args.record)
+
+    replay.start()
+    try:
+        gevent.joinall([gevent.spawn(replay.replay_inbound, trace), gevent.spawn(replay.send_outbound)])
+        replay.wait_for_drain(timeout=30)
+        results = replay.report()
+    finally:
+        replay.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for direction in ('discord_to_hook', 'irc_to_rest'):
+        stats = results[direction]
+        if stats['count']:
+            print('%-16s n=%-6d lost=%-5d p50=%.1fms p95=%.1fms p99=%.1fms max=%.1fms' % (
+                  direction, stats['count'], stats['lost'], stats['p50'] * 1000, stats['p95'] * 1000,
+                  stats['p99'] * 1000, stats['max'] * 1000))
+        else:
+            print('%-16s no messages received (lost=%d)' % (direction, stats['lost']))
+    print('REST requests: %(requests)s, rate limited: %(ratelimited)s' % dict({'requests': 0, 'ratelimited': 0},
+                                                                              **results['mock']))
+    print('Wrote results to %s' % args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""
+Generators for synthetic Discord gateway payloads.
+
+All functions return raw gateway-style dicts (as Discord would send them), so they can be turned into
+disco objects via disco.gateway.events.GatewayEvent.from_dispatch() or sent over a websocket as-is.
+"""
+
+import random
+import time
+
+# Discord permission bits used below
+READ_MESSAGES = 1 << 10
+SEND_MESSAGES = 1 << 11
+MANAGE_MESSAGES = 1 << 13
+KICK_MEMBERS = 1 << 1
+ADMINISTRATOR = 1 << 3
+
+DISCORD_EPOCH = 1420070400000
+JOINED_AT = '2020-01-01T00:00:00.000000+00:00'
+
+class SnowflakeGenerator:
+    """Generates increasing Discord-style snowflake IDs."""
+    def __init__(self, start=None):
+        self.timestamp = start or int(time.time() * 1000)
+        self.increment = 0
+
+    def __call__(self):
+        self.increment = (self.increment + 1) % 4096
+        if not self.increment:
+            self.timestamp += 1
+        return ((self.timestamp - DISCORD_EPOCH) << 22) | self.increment
+
+def make_user(snowflake, rng, bot=False, name_prefix='user'):
+    user_id = snowflake()
+    return {
+        'id': str(user_id),
+        'username': '%s%d' % (name_prefix, user_id % 1000000),
+        'discriminator': '%04d' % rng.randrange(10000),
+        'avatar': None,
+        'bot': bot,
+    }
+
+def make_guild(member_count, channel_count=50, role_count=20, category_count=5, seed=0, bot_user=None):
+    """
+    Returns a GUILD_CREATE payload with a realistic distribution of roles, channel overwrites,
+    members and presences.
+
+    - Most members have no extra roles, and a few have several.
+    - About a third of channels hide themselves from @everyone and grant access to a few roles instead.
+    - About half of members are online (with a mix of idle/dnd); the rest have no presence.
+    """
+    rng = random.Random(seed)
+    snowflake = SnowflakeGenerator(start=DISCORD_EPOCH + 10**9 + seed)
+    guild_id = snowflake()
+
+    # The @everyone role has the same ID as the guild
+    roles = [{'id': str(guild_id), 'name': '@everyone', 'permissions': READ_MESSAGES | SEND_MESSAGES,
+              'position': 0, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}]
+    for position in range(1, role_count + 1):
+        permissions = READ_MESSAGES | SEND_MESSAGES
+        roll = rng.random()
+        if roll < 0.05:
+            permissions |= ADMINISTRATOR
+        elif roll < 0.2:
+            permissions |= MANAGE_MESSAGES | KICK_MEMBERS
+        elif roll < 0.35:
+            permissions |= KICK_MEMBERS
+        roles.append({'id': str(snowflake()), 'name': 'role%d' % position, 'permissions': permissions,
+                      'position': position, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': True})
+    role_ids = [role['id'] for role in roles[1:]]
+
+    channels = []
+    categories = []
+    for position in range(category_count):
+        category_id = str(snowflake())
+        categories.append(category_id)
+        channels.append({'id': category_id, 'type': 4, 'name': 'category%d' % position, 'position': position,
+                         'permission_overwrites': []})
+    for position in range(channel_count):
+        overwrites = []
+        if rng.random() < 0.33:  # Private channel visible to some roles only
+            overwrites.append({'id': str(guild_id), 'type': 'role', 'allow': 0, 'deny': READ_MESSAGES})
+            for role_id in rng.sample(role_ids, min(len(role_ids), rng.randint(1, 3))):
+                overwrites.append({'id': role_id, 'type': 'role', 'allow': READ_MESSAGES, 'deny': 0})
+        elif rng.random() < 0.2:  # Read-only channel
+            overwrites.append({'id': str(guild_id), 'type': 'role', 'allow': 0, 'deny': SEND_MESSAGES})
+        channels.append({'id': str(snowflake()), 'type': 0, 'name': 'channel%d' % position,
+                         'position': position, 'parent_id': rng.choice(categories) if categories else None,
+                         'permission_overwrites': overwrites, 'topic': None, 'nsfw': False})
+
+    members = []
+    presences = []
+    bot_user = bot_user or make_user(snowflake, rng, bot=True, name_prefix='PyLink')
+    members.append({'user': bot_user, 'nick': None, 'roles': [], 'joined_at': JOINED_AT,
+                    'deaf': False, 'mute': False})
+    presences.append({'user': {'id': bot_user['id']}, 'status': 'online', 'game': None})
+
+    for _ in range(member_count):
+        user = make_user(snowflake, rng)
+        role_count_roll = rng.random()
+        if role_count_roll < 0.5:
+            member_roles = []
+        elif role_count_roll < 0.8:
+            member_roles = rng.sample(role_ids, 1)
+        elif role_count_roll < 0.95:
+            member_roles = rng.sample(role_ids, min(2, len(role_ids)))
+        else:
+            member_roles = rng.sample(role_ids, min(rng.randint(3, 6), len(role_ids)))
+        members.append({'user': user, 'nick': ('nick%s' % user['id'][-6:]) if rng.random() < 0.2 else None,
+                        'roles': member_roles, 'joined_at': JOINED_AT, 'deaf': False, 'mute': False})
+
+        presence_roll = rng.random()
+        if presence_roll < 0.35:
+            status = 'online'
+        elif presence_roll < 0.45:
+            status = 'idle'
+        elif presence_roll < 0.5:
+            status = 'dnd'
+        else:
+            continue
+        presences.append({'user': {'id': user['id']}, 'status': status, 'game': None})
+
+    return {
+        'id': str(guild_id),
+        'name': 'Synthetic guild (%d members)' % member_count,
+        'owner_id': members[1]['user']['id'] if len(members) > 1 else bot_user['id'],
+        'region': 'us-east',
+        'roles': roles,
+        'channels': channels,
+        'members': members,
+        'presences': presences,
+        'member_count': len(members),
+        'large': member_count > 250,
+        'unavailable': False,
+        'features': [],
+        'emojis': [],
+        'voice_states': [],
+    }
+
+def text_channels(guild):
+    """Returns the IDs of all text channels in the given guild payload."""
+    return [channel['id'] for channel in guild['channels'] if channel['type'] == 0]
+
+def member_update(guild, member, rng):
+    """Returns a GUILD_MEMBER_UPDATE payload that shuffles the given member's roles and nick."""
+    role_ids = [role['id'] for role in guild['roles'][1:]]
+    return {
+        'guild_id': guild['id'],
+        'user': member['user'],
+        'nick': rng.choice([None, 'renamed%d' % rng.randrange(1000)]),
+        'roles': rng.sample(role_ids, rng.randint(0, min(3, len(role_ids)))),
+        'joined_at': JOINED_AT,
+    }
+
+def channel_update(guild, channel_id, rng):
+    """Returns a CHANNEL_UPDATE payload that replaces the given channel's permission overwrites."""
+    channel = next(channel for channel in guild['channels'] if channel['id'] == channel_id)
+    role_ids = [role['id'] for role in guild['roles'][1:]]
+    overwrites = []
+    if rng.random() < 0.5:
+        overwrites.append({'id': guild['id'], 'type': 'role', 'allow': 0, 'deny': READ_MESSAGES})
+        for role_id in rng.sample(role_ids, min(len(role_ids), rng.randint(1, 3))):
+            overwrites.append({'id': role_id, 'type': 'role', 'allow': READ_MESSAGES, 'deny': 0})
+    return dict(channel, guild_id=guild['id'], permission_overwrites=overwrites)
+
+def presence_update(guild, member, rng):
+    """Returns a PRESENCE_UPDATE payload with a random status for the given member."""
+    return {
+        'guild_id': guild['id'],
+        'user': {'id': member['user']['id']},
+        'roles': member['roles'],
+        'status': rng.choice(['online', 'idle', 'dnd', 'offline']),
+        'game': None,
+    }
+
+def message_create(guild, channel_id, member, content, message_id):
+    """Returns a MESSAGE_CREATE payload for the given member."""
+    return {
+        'id': str(message_id),
+        'channel_id': str(channel_id),
+        'guild_id': guild['id'],
+        'author': member['user'],
+        'member': {'roles': member['roles'], 'joined_at': JOINED_AT, 'deaf': False, 'mute': False},
+        'content': content,
+        'timestamp': '2020-01-01T00:00:00.000000+00:00',
+        'edited_timestamp': None,
+        'tts': False,
+        'mention_everyone': False,
+        'mentions': [],
+        'mention_roles': [],
+        'attachments': [],
+        'embeds': [],
+        'pinned': False,
+        'type': 0,
+    }
+
+WORDS = ['hello', 'relay', 'discord', 'irc', 'network', 'channel', 'message', 'snake_case', 'see', 'the', 'a', 'of',
+         '2*3', 'ok', 'what', 'is', 'this', 'pylink']
+
+def mention_content(guild, rng):
+    """Returns message content mentioning random members, roles and channels, as Discord sends it."""
+    members = guild['members'][1:]
+    role_ids = [role['id'] for role in guild['roles'][1:]]
+    words = rng.choices(WORDS, k=rng.randint(3, 12))
+    for idx in range(len(words)):
+        roll = rng.random()
+        if roll < 0.15:
+            words[idx] = '<@%s>' % rng.choice(members)['user']['id']
+        elif roll < 0.2:
+            words[idx] = '<@!%s>' % rng.choice(members)['user']['id']
+        elif roll < 0.25:
+            words[idx] = '<@&%s>' % rng.choice(role_ids)
+        elif roll < 0.3:
+            words[idx] = '<#%s>' % rng.choice(text_channels(guild))
+    return ' '.join(words)
+
+def irc_line(rng):
+    """Returns a chat line with a mix of IRC formatting codes, colors, URLs and mass mentions."""
+    words = rng.choices(WORDS, k=rng.randint(3, 20))
+    for idx in range(len(words)):
+        roll = rng.random()
+        if roll < 0.05:
+            words[idx] = '\x02%s\x02' % words[idx]
+        elif roll < 0.08:
+            words[idx] = '\x1d%s\x1d' % words[idx]
+        elif roll < 0.1:
+            words[idx] = '\x03%d,%d%s\x03' % (rng.randrange(16), rng.randrange(16), words[idx])
+        elif roll < 0.12:
+            words[idx] = 'https://example.com/some_path/%d' % rng.randrange(1000)
+        elif roll < 0.13:
+            words[idx] = rng.choice(['@here', '@everyone'])
+    return ' '.join(words)
+
+def markdown_line(rng):
+    """Returns a chat line with a mix of Discord markdown, as Discord users would send."""
+    words = rng.choices(WORDS, k=rng.randint(3, 20))
+    for idx in range(len(words)):
+        roll = rng.random()
+        if roll < 0.05:
+            words[idx] = '**%s**' % words[idx]
+        elif roll < 0.08:
+            words[idx] = '*%s*' % words[idx]
+        elif roll < 0.1:
+            words[idx] = '`%s`' % words[idx]
+        elif roll < 0.11:
+            words[idx] = '||%s||' % words[idx]
+        elif roll < 0.13:
+            words[idx] = 'https://example.com/some_path/%d' % rng.randrange(1000)
+    if rng.random() < 0.02:
+        words.append('```\ncode block\nwith two lines\n```')
+    return ' '.join(words)
@@ -20,31 +20,45 @@ __version__ = '0.2.0'
 
 import calendar
 import collections
+import functools
+import itertools
+import json
+import os.path
 import queue
+import re
+import secrets
 import string
+import sys
 import threading
+import time
 import urllib.parse
 
-import socket, gevent.socket
+import socket, gevent.monkey, gevent.socket
 
 if socket.socket is not gevent.socket.socket:
     raise ImportError("gevent patching must be enabled for protocols/discord to work. "
                       "Make sure you are starting with the pylink-discord launcher.")
 
-from disco.api.http import APIException
+from disco.api.client import APIClient
+from disco.api.http import APIException, Routes
 from disco.bot import Bot, BotConfig
 from disco.bot import Plugin
 from disco.client import Client, ClientConfig
 from disco.gateway import events
 from disco.types import Guild, Channel as DiscordChannel, GuildMember, Message
 from disco.types.channel import ChannelType
+from disco.types.message import MessageEmbed
 from disco.types.permissions import Permissions
 from disco.types.user import Status as DiscordStatus
 #from disco.util.logging import setup_logging
+from gevent.pywsgi import WSGIServer
 from holster.emitter import Priority
+import requests.adapters
+import urllib3.connection
 
-from pylinkirc import structures, utils, world
+from pylinkirc import conf, structures, utils, world
 from pylinkirc.classes import *
+from pylinkirc.coremods import permissions
 from pylinkirc.log import log
 import pylinkirc
 try:
@@ -60,6 +74,25 @@ except ImportError:
     log.info('discord: libgravatar not installed - avatar support will be disabled.')
 
 BATCH_DELAY = 0.3  # TODO: make this configurable
+# Minimum time between reports of dropped messages for the same channel
+OVERFLOW_REPORT_INTERVAL = 60
+# Compact mode (see _use_compact_mode): 429 responses are counted over this many seconds, and channels stay
+# in compact mode for at least this long
+COMPACT_RATELIMIT_WINDOW = 30
+COMPACT_MIN_DURATION = 10
+# Packed messages sent as attachments include this many lines as a preview
+PACK_PREVIEW_LINES = 3
+# Send out buffered messages after this many seconds, even if more keep arriving
+MAX_BATCH_DELAY = 1.0
+# Sender accounts rate limited within this many seconds are avoided when choosing one to send a message
+SENDER_RATELIMIT_WINDOW = 30
+
+# Everything runs in greenlets on one OS thread, so tools that need to look at the hub's stack from the
+# outside (e.g. StackSampler) must use real threads.
+_start_native_thread, _get_native_thread_ident, _allocate_native_lock = \
+    gevent.monkey.get_original('_thread', ['start_new_thread', 'get_ident', 'allocate_lock'])
+_native_sleep = gevent.monkey.get_original('time', 'sleep')
+_STDLIB_DIR = os.path.dirname(os.__file__)
 
 class DiscordChannelState(structures.CaseInsensitiveDict):
     @staticmethod
@@ -70,6 +103,949 @@ class DiscordChannelState(structures.CaseInsensitiveDict):
             raise KeyError("Cannot convert channel ID %r to int" % key)
         return key
 
+class LRUCache(collections.OrderedDict):
+    """
+    OrderedDict that evicts its least recently used entries once it holds more than maxsize items.
+    """
+    def __init__(self, maxsize, *args, **kwargs):
+        self.maxsize = maxsize
+        super().__init__(*args, **kwargs)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, holding up to capacity tokens which are refilled at rate tokens per second.
+    """
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, amount):
+        """Takes up to amount tokens from the bucket, and returns how many were taken."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        taken = max(0, min(amount, int(self.tokens)))
+        self.tokens -= taken
+        return taken
+
+class NickIndex:
+    """
+    Case-insensitive index of a guild's member names (guild nicks and usernames) to member IDs, used to turn
+    IRC-style nick highlights into Discord mentions without searching the member list.
+    """
+    def __init__(self):
+        # casefolded name -> set of member IDs
+        self._names = collections.defaultdict(set)
+        # member ID -> casefolded names indexed for that member
+        self._members = {}
+
+    def __len__(self):
+        return len(self._members)
+
+    def update(self, uid, *names):
+        """Sets the names indexed for the given member."""
+        names = {name.casefold() for name in names if name}
+        old_names = self._members.get(uid, set())
+        for name in old_names - names:
+            self._discard(name, uid)
+        for name in names - old_names:
+            self._names[name].add(uid)
+        self._members[uid] = names
+
+    def remove(self, uid):
+        """Removes the given member from the index."""
+        for name in self._members.pop(uid, ()):
+            self._discard(name, uid)
+
+    def _discard(self, name, uid):
+        uids = self._names.get(name)
+        if uids:
+            uids.discard(uid)
+            if not uids:
+                del self._names[name]
+
+    def lookup(self, name):
+        """Returns the ID of the member with the given name, or None if there is no such member or several."""
+        uids = self._names.get(name.casefold())
+        if uids and len(uids) == 1:
+            return next(iter(uids))
+
+class MentionRenderer:
+    """
+    Renders user, role, and channel mentions in a guild's messages as plain text (@nick, @role, #channel),
+    caching the rendered names. Cached names must be invalidated when the member, role or channel changes.
+    """
+    _mention_re = re.compile(r'<(@!?|@&|#)(\d+)>')
+    _kinds = {'@': 'user', '@!': 'user', '@&': 'role', '#': 'channel'}
+
+    def __init__(self, guild, maxsize=1000):
+        self.guild = guild
+        # (kind, ID) -> rendered text
+        self.cache = LRUCache(maxsize=maxsize)
+
+    def invalidate(self, kind, oid):
+        """Removes the cached name for the given user, role, or channel ID."""
+        self.cache.pop((kind, oid), None)
+
+    def render(self, message):
+        """Returns the message's content with mentions replaced."""
+        content = message.content
+        if '<' not in content:  # Fast path: no mentions
+            return content
+        return self._mention_re.sub(functools.partial(self._replace, message), content)
+
+    def _replace(self, message, match):
+        kind = self._kinds[match.group(1)]
+        oid = int(match.group(2))
+        try:
+            return self.cache[(kind, oid)]
+        except KeyError:
+            pass
+
+        rendered = None
+        cacheable = True
+        if kind == 'user':
+            # Try to find the user's guild nick, falling back to the user if that fails
+            member = self.guild.members.get(oid)
+            if member:
+                rendered = '@' + member.name
+            elif oid in message.mentions:
+                # Not a guild member, so we won't see updates for this user
+                rendered = '@' + str(message.mentions[oid])
+                cacheable = False
+        elif kind == 'role':
+            role = self.guild.roles.get(oid)
+            if role:
+                rendered = '@' + str(role)
+        else:
+            channel = message.client.state.channels.get(oid)
+            if channel:
+                rendered = str(channel)
+
+        if rendered is None:  # Unknown mention; leave it alone
+            return match.group()
+        if cacheable:
+            self.cache[(kind, oid)] = rendered
+        return rendered
+
+class MessageQueue:
+    """
+    Outbound message queue with priority lanes, implementing the parts of queue.Queue used by the
+    message builder.
+
+    Lanes are served in the order of LANES. Within each lane, channels take turns, so that one busy
+    channel can't hold up messages to the others.
+
+    The queue can be bounded globally (maxsize) and per channel (channel_maxsize). When full, the oldest
+    message is dropped: from the same channel, or for the global bound, from the most backlogged channel
+    in the lowest priority lane. With the "summarize" policy, dropped messages are replaced by a single
+    "N lines omitted" note per channel. Messages older than ttl seconds are expired when they come up for
+    sending. Dropped and expired messages are passed to on_overflow(reason, messages).
+    """
+    LANES = ('priority', 'relay', 'notice')
+    POLICIES = ('drop_oldest', 'summarize')
+
+    def __init__(self, maxsize=0, channel_maxsize=0, policy='drop_oldest', ttl=0, on_overflow=None):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown overflow policy %r (must be one of %s)" % (policy, ', '.join(self.POLICIES)))
+        self.maxsize = maxsize
+        self.channel_maxsize = channel_maxsize
+        self.policy = policy
+        self.ttl = ttl
+        self.on_overflow = on_overflow
+
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        # lane -> OrderedDict of channel -> deque of QueuedMessage
+        self._lanes = {lane: collections.OrderedDict() for lane in self.LANES}
+        self._sizes = dict.fromkeys(self.LANES, 0)
+
+    def put_nowait(self, message):
+        dropped = []
+        with self._mutex:
+            lane, channel = message.lane, message.channel
+            if self.channel_maxsize and self._channel_size(lane, channel) >= self.channel_maxsize:
+                dropped.append(self._drop_oldest(lane, channel))
+            elif self.maxsize and self._qsize() >= self.maxsize:
+                largest = self._find_most_backlogged()
+                if largest:
+                    dropped.append(self._drop_oldest(*largest))
+
+            self._lanes[lane].setdefault(channel, collections.deque()).append(message)
+            self._sizes[lane] += 1
+            self._not_empty.notify()
+
+        if dropped and self.on_overflow:
+            self.on_overflow('dropped', dropped)
+
+    def get(self, timeout=None, exclude=()):
+        """
+        Returns the next message to send, waiting up to timeout seconds for one.
+        Raises queue.Empty if none was available.
+
+        exclude is a collection of (lane, channel) pairs whose messages are left in the queue. It is meant for
+        non-blocking calls (timeout=0): if only excluded messages are left, this raises queue.Empty right away.
+        """
+        expired = []
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            with self._not_empty:
+                while True:
+                    remaining = deadline - time.monotonic() if deadline is not None else None
+                    if not self._not_empty.wait_for(self._qsize, remaining):
+                        raise queue.Empty
+
+                    message = self._pop(exclude)
+                    if message is None:
+                        raise queue.Empty
+                    if self.ttl and not message.omitted and time.monotonic() - message.queued_at > self.ttl:
+                        expired.append(message)
+                        if self.policy == 'summarize':
+                            self._add_omitted(message)
+                        continue
+                    return message
+        finally:
+            if expired and self.on_overflow:
+                self.on_overflow('expired', expired)
+
+    def _pop(self, exclude=()):
+        """
+        Removes and returns the next message in line, skipping the (lane, channel) pairs in exclude.
+        Returns None if there is no such message.
+        """
+        for lane in self.LANES:
+            channels = self._lanes[lane]
+            for channel, messages in channels.items():
+                if (lane, channel) in exclude:
+                    continue
+                message = messages.popleft()
+                if messages:  # Move this channel to the back of the line
+                    channels.move_to_end(channel)
+                else:
+                    del channels[channel]
+                self._sizes[lane] -= 1
+                return message
+
+    def _channel_size(self, lane, channel):
+        """Returns the amount of queued messages for the channel in the given lane, not counting summaries."""
+        messages = self._lanes[lane].get(channel)
+        if not messages:
+            return 0
+        return len(messages) - bool(messages[0].omitted)
+
+    def _find_most_backlogged(self):
+        """Returns the (lane, channel) pair with the most queued messages, checking lower priority lanes first."""
+        for lane in reversed(self.LANES):
+            if self._lanes[lane]:
+                channel = max(self._lanes[lane], key=lambda channel: self._channel_size(lane, channel))
+                if self._channel_size(lane, channel):
+                    return (lane, channel)
+
+    def _drop_oldest(self, lane, channel):
+        """Removes and returns the oldest message for the channel in the given lane."""
+        channels = self._lanes[lane]
+        messages = channels[channel]
+        if messages[0].omitted:  # Keep the summary in front
+            dropped = messages[1]
+            del messages[1]
+        else:
+            dropped = messages.popleft()
+        self._sizes[lane] -= 1
+        if not messages:
+            del channels[channel]
+
+        if self.policy == 'summarize':
+            self._add_omitted(dropped)
+        return dropped
+
+    def _add_omitted(self, message):
+        """Counts the given message in the "lines omitted" summary for its channel."""
+        messages = self._lanes[message.lane].setdefault(message.channel, collections.deque())
+        if messages and messages[0].omitted:
+            summary = messages[0]
+        else:
+            summary = QueuedMessage(message.channel, message.pylink_target, '', lane=message.lane)
+            messages.appendleft(summary)
+            self._sizes[message.lane] += 1
+        summary.omitted += 1
+        summary.text = summary.raw_text = '(%d older line(s) omitted due to backlog)' % summary.omitted
+
+    def _qsize(self):
+        return sum(self._sizes.values())
+
+    def qsize(self):
+        with self._mutex:
+            return self._qsize()
+
+    def lane_size(self, lane):
+        """Returns the amount of messages waiting in the given lane."""
+        return self._sizes[lane]
+
+    def channel_size(self, channel):
+        """Returns the amount of messages waiting for the given channel, in all lanes."""
+        with self._mutex:
+            return sum(self._channel_size(lane, channel) for lane in self.LANES)
+
+    def channel_messages(self, channel):
+        """Returns a list of the messages waiting for the given channel, in the order they will be sent."""
+        with self._mutex:
+            return [message for lane in self.LANES for message in self._lanes[lane].get(channel, ())]
+
+class MessageSpool:
+    """
+    Append-only journal of outgoing messages, so that messages still queued when PyLink exits or crashes
+    can be sent after a restart.
+
+    Each queued message is written as an "enqueue" record, and an "ack" record is written once it has been
+    sent (or dropped). Writes are buffered and flushed to disk by sync(), which the message builder calls
+    once per batch before sending it (group commit), so the cost is one fsync per batch instead of one per
+    message. Delivery is at least once: messages sent right before a crash may be sent again.
+    """
+    # Rewrite the spool file once this many records have been acknowledged since the last rewrite
+    COMPACT_THRESHOLD = 10000
+    # Fields that enqueue records must have
+    RECORD_FIELDS = frozenset(('id', 'ts', 'guild', 'channel', 'target', 'nick', 'text'))
+
+    def __init__(self, filename, ttl=3600):
+        self.filename = filename
+        self.ttl = ttl
+        # spool ID -> enqueue record
+        self.pending = {}
+        self._file = None
+        # Records written while the file is being rewritten, to append once it is reopened
+        self._rewrite_backlog = None
+        self._dirty = False
+        self._acked = 0
+        self._ids = itertools.count()
+        # Makes spool IDs unique across restarts
+        self._id_prefix = '%x' % time.time_ns()
+
+    @property
+    def is_open(self):
+        return self._file is not None or self._rewrite_backlog is not None
+
+    def open(self):
+        """
+        Loads unsent messages from the spool file, dropping those older than the TTL, and opens the file for
+        writing. Returns the loaded enqueue records, oldest first.
+        """
+        records = {}
+        try:
+            with open(self.filename, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        if record.get('op') == 'enqueue':
+                            if not self.RECORD_FIELDS <= record.keys():
+                                raise KeyError('missing fields')
+                            elif not isinstance(record['ts'], (int, float)):
+                                raise TypeError('invalid timestamp')
+                            records[record['id']] = record
+                        elif record.get('op') == 'ack':
+                            for spool_id in record['ids']:
+                                records.pop(spool_id, None)
+                    # Probably cut off by a crash, or otherwise corrupt
+                    except (ValueError, AttributeError, KeyError, TypeError):
+                        log.debug('discord: skipping invalid spool record %r in %s', line, self.filename)
+                        continue
+        except FileNotFoundError:
+            pass
+
+        cutoff = time.time() - self.ttl
+        self.pending = {spool_id: record for spool_id, record in records.items()
+                        if not self.ttl or record['ts'] >= cutoff}
+        self._rewrite()
+        return list(self.pending.values())
+
+    def _rewrite(self):
+        """
+        Atomically replaces the spool file with one containing only pending records. The new file is written
+        in gevent's thread pool, so that a slow disk doesn't block the hub; records added in the meantime are
+        appended once it has been reopened.
+        """
+        if self._file:
+            self._file.close()
+            self._file = None
+        self._rewrite_backlog = []
+        self._acked = 0
+        self._dirty = False
+        try:
+            gevent.get_hub().threadpool.apply(self._write_file, (list(self.pending.values()),))
+            self._file = open(self.filename, 'a', encoding='utf-8')
+        finally:
+            backlog, self._rewrite_backlog = self._rewrite_backlog, None
+        for line in backlog:
+            self._write(line)
+
+    def _write_file(self, records):
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname, self.filename)
+
+    def _write(self, line):
+        if self._file:
+            self._file.write(line)
+            self._dirty = True
+        elif self._rewrite_backlog is not None:
+            self._rewrite_backlog.append(line)
+
+    def append(self, message, guild_id):
+        """Writes an enqueue record for the given QueuedMessage, and sets its spool ID."""
+        spool_id = message.spool_id = '%s-%d' % (self._id_prefix, next(self._ids))
+        record = {'op': 'enqueue', 'id': spool_id, 'ts': time.time(), 'guild': guild_id,
+                  'channel': message.channel.id, 'target': message.pylink_target,
+                  'nick': message.sender.nick if message.sender else None, 'text': message.text}
+        self.pending[spool_id] = record
+        self._write(json.dumps(record) + '\n')
+
+    def ack(self, spool_ids):
+        """Marks the messages with the given spool IDs as done."""
+        spool_ids = [spool_id for spool_id in spool_ids if self.pending.pop(spool_id, None)]
+        if spool_ids:
+            self._write(json.dumps({'op': 'ack', 'ids': spool_ids}) + '\n')
+            self._acked += len(spool_ids)
+
+    def sync(self):
+        """
+        Flushes buffered records to disk, if any. fsync runs in gevent's thread pool, so that a slow disk
+        doesn't block the hub.
+        """
+        if not (self._dirty and self._file):
+            return
+        if self._acked >= self.COMPACT_THRESHOLD and self._acked > len(self.pending):
+            self._rewrite()
+            return
+        self._dirty = False
+        self._file.flush()
+        gevent.get_hub().threadpool.apply(os.fsync, (self._file.fileno(),))
+
+    def close(self):
+        """Flushes buffered records to disk and closes the spool file."""
+        if self._file:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+class DiscordMetrics:
+    """
+    Thread-safe registry of counters, gauges, and histograms, which can be rendered in the
+    Prometheus text exposition format.
+    """
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.gauge_functions = {}
+        # (name, labels) -> [buckets, bucket counts, sum, count, max]
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name, amount=1, **labels):
+        """Increments the counter with the given name and labels."""
+        with self._lock:
+            self.counters[self._key(name, labels)] += amount
+
+    def set(self, name, value, **labels):
+        """Sets the gauge with the given name and labels."""
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def set_function(self, name, func, **labels):
+        """Registers a gauge whose value is computed by calling func() at read time."""
+        with self._lock:
+            self.gauge_functions[self._key(name, labels)] = func
+
+    def observe(self, name, value, buckets=None, **labels):
+        """Records a value in the histogram with the given name and labels."""
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                buckets = tuple(buckets or self.DEFAULT_BUCKETS)
+                hist = self.histograms[key] = [buckets, [0] * len(buckets), 0, 0, 0]
+            for idx, bound in enumerate(hist[0]):
+                if value <= bound:
+                    hist[1][idx] += 1
+            hist[2] += value
+            hist[3] += 1
+            hist[4] = max(hist[4], value)
+
+    def get(self, name, **labels):
+        """Returns the current value of a counter or gauge, or 0 if it hasn't been set."""
+        key = self._key(name, labels)
+        with self._lock:
+            if key in self.gauge_functions:
+                return self.gauge_functions[key]()
+            return self.gauges.get(key, self.counters.get(key, 0))
+
+    def _collect_gauges(self):
+        gauges = self.gauges.copy()
+        for key, func in self.gauge_functions.items():
+            try:
+                gauges[key] = func()
+            except Exception:
+                log.debug('discord: failed to read gauge %s', key, exc_info=True)
+        return gauges
+
+    @staticmethod
+    def _format_labels(labels, **extra):
+        labels = list(labels) + [(k, str(v)) for k, v in extra.items()]
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in labels)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for metric_type, values in (('counter', self.counters), ('gauge', self._collect_gauges())):
+                seen = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in seen:
+                        lines.append('# TYPE %s %s' % (name, metric_type))
+                        seen.add(name)
+                    lines.append('%s%s %s' % (name, self._format_labels(labels), value))
+
+            seen = set()
+            for (name, labels), (buckets, counts, total, count, _) in sorted(self.histograms.items()):
+                if name not in seen:
+                    lines.append('# TYPE %s histogram' % name)
+                    seen.add(name)
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append('%s_bucket%s %s' % (name, self._format_labels(labels, le=bound), bucket_count))
+                lines.append('%s_bucket%s %s' % (name, self._format_labels(labels, le='+Inf'), count))
+                lines.append('%s_sum%s %s' % (name, self._format_labels(labels), total))
+                lines.append('%s_count%s %s' % (name, self._format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, prefix=''):
+        """Returns a list of human readable lines describing all metrics whose names start with prefix."""
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()) + sorted(self._collect_gauges().items()):
+                if name.startswith(prefix):
+                    lines.append('%s%s = %s' % (name, self._format_labels(labels), value))
+            for (name, labels), (_, _, total, count, maximum) in sorted(self.histograms.items()):
+                if name.startswith(prefix):
+                    lines.append('%s%s: count=%d avg=%.4f max=%.4f' % (name, self._format_labels(labels), count,
+                                                                       total / count if count else 0, maximum))
+        return lines
+
+    def totals(self):
+        """
+        Returns a list of "name=value" strings with one entry per metric, combining all label sets:
+        counters are summed, gauges are shown as a range if they have several label sets, and histograms
+        show the total count and the overall average and maximum.
+        """
+        counters = collections.Counter()
+        gauges = collections.defaultdict(list)
+        histograms = {}
+        with self._lock:
+            for (name, _), value in self.counters.items():
+                counters[name] += value
+            for (name, _), value in self._collect_gauges().items():
+                gauges[name].append(value)
+            for (name, _), (_, _, total, count, maximum) in self.histograms.items():
+                old_total, old_count, old_max = histograms.get(name, (0, 0, 0))
+                histograms[name] = (old_total + total, old_count + count, max(old_max, maximum))
+
+        totals = ['%s=%s' % (name, value) for name, value in sorted(counters.items())]
+        for name, values in sorted(gauges.items()):
+            if len(values) == 1:
+                totals.append('%s=%s' % (name, values[0]))
+            else:
+                totals.append('%s=%s..%s' % (name, min(values), max(values)))
+        for name, (total, count, maximum) in sorted(histograms.items()):
+            totals.append('%s=count:%d/avg:%.4f/max:%.4f' % (name, count, total / count if count else 0, maximum))
+        return totals
+
+class SenderClient:
+    """
+    A Discord account used to send messages to guild channels. Besides the main bot account, extra "sender"
+    bot accounts can be configured, so that sends are spread over each account's rate limits.
+    """
+    def __init__(self, name, api, guild_ids=None):
+        self.name = name
+        self.api = api
+        self.user_id = None
+        # IDs of guilds this account is in, or None if it is in all of them (the main bot account)
+        self.guild_ids = guild_ids
+        # Times of recent 429 responses
+        self.ratelimit_hits = collections.deque()
+        # IDs of channels this account was refused access to (e.g. missing permissions)
+        self.failed_channels = set()
+
+    def in_guild(self, guild_id):
+        """Returns whether this account can send messages to the given guild."""
+        return self.guild_ids is None or guild_id in self.guild_ids
+
+    def can_send(self, channel):
+        """Returns whether this account can send messages to the given channel."""
+        return self.in_guild(channel.guild_id) and channel.id not in self.failed_channels
+
+    def count_recent_ratelimits(self):
+        """Returns the amount of 429 responses received in the last SENDER_RATELIMIT_WINDOW seconds."""
+        cutoff = time.monotonic() - SENDER_RATELIMIT_WINDOW
+        while self.ratelimit_hits and self.ratelimit_hits[0] < cutoff:
+            self.ratelimit_hits.popleft()
+        return len(self.ratelimit_hits)
+
+class PooledHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    requests transport adapter that can set socket options (e.g. TCP keep-alive) on pooled connections,
+    and reports connection reuse.
+    """
+    def __init__(self, socket_options=None, **kwargs):
+        # This must be set first, as HTTPAdapter.__init__ calls init_poolmanager()
+        self.socket_options = socket_options
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+    def get_pool_stats(self):
+        """
+        Returns the amount of connections opened and requests made by all current connection pools.
+        """
+        connections = requests_made = 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:  # Evicted in the meantime
+                continue
+            connections += pool.num_connections
+            requests_made += pool.num_requests
+        return connections, requests_made
+
+    def get_reuse_ratio(self):
+        """Returns the fraction of requests that reused an existing connection."""
+        connections, requests_made = self.get_pool_stats()
+        if not requests_made:
+            return 0
+        return max(0, 1 - connections / requests_made)
+
+class StackSampler:
+    """
+    Sampling profiler for the gevent hub thread. Samples are taken from a native thread so that code
+    blocking the hub shows up too, and are written in the "folded" stack format understood by
+    flamegraph.pl and speedscope.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.running = False
+        self._lock = _allocate_native_lock()
+        self._target_thread = None
+
+    def start(self):
+        """Starts sampling the thread this is called from."""
+        self._target_thread = _get_native_thread_ident()
+        self.running = True
+        _start_native_thread(self._run, ())
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            frame = sys._current_frames().get(self._target_thread)
+            if frame is not None:
+                stack = self.format_stack(frame)
+                with self._lock:
+                    self.stacks[stack] += 1
+            _native_sleep(self.interval)
+
+    @staticmethod
+    def format_stack(frame):
+        """Returns the given frame's stack as a folded (root first, semicolon separated) string."""
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        return ';'.join(reversed(parts))
+
+    def dump(self, filename):
+        """Writes the collected samples to filename, returning the amount of samples written."""
+        with self._lock:
+            stacks = self.stacks.most_common()
+        with open(filename, 'w') as f:
+            for stack, count in stacks:
+                f.write('%s %d\n' % (stack, count))
+        return sum(count for _, count in stacks)
+
+class HubBlockMonitor:
+    """
+    Detects when the gevent hub has been blocked for longer than a threshold.
+
+    A greenlet refreshes a heartbeat every few milliseconds, while a native thread watches it and captures
+    the hub thread's stack whenever the heartbeat falls behind. Once the heartbeat greenlet runs again, it
+    attributes the blocked time to the captured call site and logs it.
+    """
+    def __init__(self, threshold=0.1):
+        self.threshold = threshold
+        self.interval = max(threshold / 4, 0.005)
+        self.running = False
+        # call site -> [times blocked, total seconds, max seconds, last stack]
+        self.call_sites = {}
+        self._last_tick = None
+        self._captured = None
+        self._target_thread = None
+
+    def start(self):
+        """Starts monitoring the hub of the thread this is called from."""
+        self._target_thread = _get_native_thread_ident()
+        self._last_tick = time.monotonic()
+        self.running = True
+        gevent.spawn(self._heartbeat)
+        _start_native_thread(self._watch, ())
+
+    def stop(self):
+        self.running = False
+
+    def _heartbeat(self):
+        while self.running:
+            gevent.sleep(self.interval)
+            now = time.monotonic()
+            blocked = now - self._last_tick - self.interval
+            self._last_tick = now
+            if blocked >= self.threshold:
+                call_site, stack = self._captured or ('<unknown>', '')
+                self._captured = None
+
+                site_stats = self.call_sites.setdefault(call_site, [0, 0, 0, ''])
+                site_stats[0] += 1
+                site_stats[1] += blocked
+                site_stats[2] = max(site_stats[2], blocked)
+                site_stats[3] = stack
+                log.warning('discord: gevent hub was blocked for %.0f ms at %s', blocked * 1000, call_site)
+                log.debug('discord: blocking stack: %s', stack)
+
+    def _watch(self):
+        # N.B. this runs outside the hub, so it must not log or take gevent locks
+        while self.running:
+            _native_sleep(self.interval)
+            if self._captured is None and time.monotonic() - self._last_tick > self.threshold + self.interval:
+                frame = sys._current_frames().get(self._target_thread)
+                if frame is not None:
+                    self._captured = (self.get_call_site(frame), StackSampler.format_stack(frame))
+
+    @staticmethod
+    def get_call_site(frame):
+        """Returns the innermost frame of the given stack that isn't part of gevent or the standard library."""
+        innermost = frame
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            is_gevent = '%sgevent%s' % (os.sep, os.sep) in filename
+            is_stdlib = filename.startswith(_STDLIB_DIR) and 'site-packages' not in filename
+            if not (is_gevent or is_stdlib):
+                break
+            frame = frame.f_back
+        frame = frame or innermost
+        return '%s (%s:%d)' % (frame.f_code.co_name, frame.f_code.co_filename, frame.f_lineno)
+
+    def get_blocked_time(self):
+        """Returns the total amount of seconds the hub has been blocked for."""
+        return sum(site_stats[1] for site_stats in list(self.call_sites.values()))
+
+# IRC formatting codes and the Discord markdown they translate to (for styles that have an equivalent)
+IRC_BOLD = '\x02'
+IRC_ITALIC = '\x1d'
+IRC_UNDERLINE = '\x1f'
+IRC_STRIKETHROUGH = '\x1e'
+IRC_MONOSPACE = '\x11'
+IRC_RESET = '\x0f'
+_irc_to_markdown = {IRC_BOLD: '**', IRC_ITALIC: '*', IRC_UNDERLINE: '__', IRC_STRIKETHROUGH: '~~', IRC_MONOSPACE: '`'}
+
+# One token per match: URLs (kept as is), IRC colors (dropped), other IRC formatting codes, mass mentions,
+# and characters that are special in Discord markdown
+_outbound_re = re.compile(r'(?P<url>https?://[^\s<>]+)'
+                          r'|(?P<color>\x03(?:\d{1,2}(?:,\d{1,2})?)?|\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?)'
+                          r'|(?P<code>[\x02\x1d\x1f\x1e\x11\x16\x0f])'
+                          r'|(?P<mention>@(?:everyone|here)\b)'
+                          r'|(?P<markdown>[\\*_~`|]|^>)')
+
+_irc_codes_re = re.compile(r'[\x02\x03\x04\x0f\x11\x16\x1d\x1e\x1f]')
+
+def _escape_token(match, escape_markdown, allow_mention_everyone):
+    kind = match.lastgroup
+    token = match.group()
+    if kind == 'mention' and not allow_mention_everyone:
+        return token.replace('@', '@ ')
+    elif kind == 'markdown' and escape_markdown:
+        return '\\' + token
+    return token
+
+def irc_to_discord(text, markdown=True, escape_markdown=True, allow_mention_everyone=False):
+    """
+    Translates IRC formatted text to Discord markdown in one pass.
+
+    If markdown is False, IRC formatting is stripped instead. If escape_markdown is True, characters that
+    Discord would interpret as markdown are escaped (except in URLs). Unless allow_mention_everyone is True,
+    @everyone and @here are broken up so that they don't ping anyone.
+    """
+    if not _irc_codes_re.search(text):
+        # Without formatting codes, there's no state to track: just escape what's needed
+        if (escape_markdown or not allow_mention_everyone) and _outbound_re.search(text):
+            return _outbound_re.sub(functools.partial(_escape_token, escape_markdown=escape_markdown,
+                                                      allow_mention_everyone=allow_mention_everyone), text)
+        return text
+
+    out = []
+    active = []   # Styles currently toggled on, in the order they were turned on
+    emitted = []  # Styles opened in the output so far
+
+    def sync_styles():
+        # Close and reopen markdown only when there's text to apply it to, so that toggling a style
+        # on and off without any text in between doesn't leave empty markers behind.
+        common = 0
+        while common < len(emitted) and common < len(active) and emitted[common] == active[common]:
+            common += 1
+        while len(emitted) > common:
+            out.append(_irc_to_markdown[emitted.pop()])
+        for style in active[common:]:
+            out.append(_irc_to_markdown[style])
+            emitted.append(style)
+
+    def add_text(chunk):
+        if chunk:
+            if markdown and active != emitted:
+                sync_styles()
+            if emitted and IRC_MONOSPACE in emitted:  # Backticks can't be escaped inside code spans
+                chunk = chunk.replace('`', 'ˋ')
+            out.append(chunk)
+
+    pos = 0
+    for match in _outbound_re.finditer(text):
+        add_text(text[pos:match.start()])
+        pos = match.end()
+        kind = match.lastgroup
+        token = match.group()
+        if kind == 'url':
+            add_text(token)
+        elif kind == 'code':
+            if token == IRC_RESET:
+                active.clear()
+            elif token in _irc_to_markdown:
+                if token in active:
+                    active.remove(token)
+                else:
+                    active.append(token)
+        elif kind == 'mention':
+            add_text(token if allow_mention_everyone else token.replace('@', '@ '))
+        elif kind == 'markdown':
+            if escape_markdown and IRC_MONOSPACE not in emitted:
+                add_text('\\' + token)
+            else:
+                add_text(token)
+    add_text(text[pos:])
+
+    while emitted:
+        out.append(_irc_to_markdown[emitted.pop()])
+    return ''.join(out)
+
+_inbound_re = re.compile(r'```(?:[\w+-]*\n)?(?P<codeblock>[\s\S]*?)```'
+                         r'|`(?P<code>[^`\n]+)`'
+                         r'|(?P<url><?https?://[^\s>]+>?)'
+                         r'|\\(?P<escaped>[\\*_~`|>])'
+                         r'|\*\*\*(?P<bold_italic>[^\n]+?)\*\*\*'
+                         r'|\*\*(?P<bold>[^\n]+?)\*\*'
+                         r'|__(?P<underline>[^\n]+?)__'
+                         r'|~~(?P<strikethrough>[^\n]+?)~~'
+                         r'|\|\|(?P<spoiler>[^\n]+?)\|\|'
+                         r'|\*(?P<italic>[^\s*](?:[^\n]*?[^\s\\*])?)\*'
+                         r'|(?<!\w)_(?P<italic_alt>[^\s_](?:[^\n]*?[^\s\\_])?)_(?!\w)')
+_markdown_to_irc = {'bold_italic': IRC_BOLD + IRC_ITALIC, 'bold': IRC_BOLD, 'underline': IRC_UNDERLINE, 'strikethrough': IRC_STRIKETHROUGH,
+                    'italic': IRC_ITALIC, 'italic_alt': IRC_ITALIC}
+# Spoilers are shown as black on black text, which is the usual convention on IRC
+_IRC_SPOILER = '\x0301,01%s\x03'
+
+def _translate_markdown(match):
+    kind = match.lastgroup
+    token = match.group(kind)
+    if kind == 'codeblock':
+        # IRC formatting doesn't carry across lines, so format each line separately
+        return '\n'.join(IRC_MONOSPACE + line + IRC_MONOSPACE if line else line
+                         for line in token.strip('\n').split('\n'))
+    elif kind == 'code':
+        return IRC_MONOSPACE + token + IRC_MONOSPACE
+    elif kind in ('url', 'escaped'):
+        return token
+    inner = _inbound_re.sub(_translate_markdown, token)
+    if kind == 'spoiler':
+        return _IRC_SPOILER % inner
+    code = _markdown_to_irc[kind]
+    return code + inner + code[::-1]
+
+def discord_to_irc(text):
+    """
+    Translates Discord markdown (bold, italics, underline, strikethrough, spoilers, code spans and blocks)
+    to IRC formatting in one pass.
+    """
+    if not any(char in text for char in '*_~`|\\'):  # Fast path for plain text
+        return text
+    return _inbound_re.sub(_translate_markdown, text)
+
+def summarize_event(event):
+    """Returns a short description of a disco gateway event, for logging."""
+    summary = [type(event).__name__]
+    for attr in ('guild_id', 'channel_id', 'id'):
+        try:
+            value = getattr(event, attr, None)
+        except Exception:  # disco events proxy attributes to their payload, which may not have them
+            value = None
+        if value:
+            summary.append('%s=%s' % (attr, value))
+    members = getattr(event, 'members', None)
+    if isinstance(members, list):
+        summary.append('members=%d' % len(members))
+    return ' '.join(summary)
+
+def timed_listener(func):
+    """
+    Decorator for DiscordBotPlugin listeners which records how long each event took to handle, and
+    logs slow handlers when profiling is enabled. This must be placed below any @Plugin.listen decorators.
+    """
+    @functools.wraps(func)
+    def wrapper(self, event, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return func(self, event, *args, **kwargs)
+        finally:
+            elapsed = time.monotonic() - start
+            self.protocol.metrics.observe('discord_listener_seconds', elapsed, event=type(event).__name__)
+            threshold = self.protocol.get_slow_handler_threshold()
+            if threshold is not None and elapsed >= threshold:
+                log.warning('(%s) Slow listener %s took %.3f seconds for event %s', self.protocol.name,
+                            func.__name__, elapsed, summarize_event(event))
+    return wrapper
+
 class DiscordBotPlugin(Plugin):
     # TODO: maybe this could be made configurable?
     # N.B. iteration order matters: we stop adding lower modes once someone has +o, much like
@@ -88,19 +1064,21 @@ class DiscordBotPlugin(Plugin):
         'INVISIBLE': 'Offline',  # not a typo :)
         'OFFLINE': 'Offline',
     }
-    _dm_channels = {}
 
     def __init__(self, protocol, bot, config):
         self.protocol = protocol
+        self._dm_channels = LRUCache(protocol.serverdata.get('dm_channel_cache_size', 1000))
         super().__init__(bot, config)
 
     @Plugin.listen('Ready')
+    @timed_listener
     def on_ready(self, event, *args, **kwargs):
         self.me = event.user
         self.protocol.connected.set()
 
     def _burst_guild(self, guild):
         log.info('(%s) bursting guild %s/%s', self.protocol.name, guild.id, guild.name)
+        start = time.monotonic()
         try:
             pylink_netobj = self.protocol._create_child(guild.id, guild.name)
         except ValueError:
@@ -122,6 +1100,8 @@ class DiscordBotPlugin(Plugin):
 
         pylink_netobj.connected.set()
         pylink_netobj.call_hooks([None, 'ENDBURST', {}])
+        self.protocol.metrics.observe('discord_guild_burst_seconds', time.monotonic() - start, guild=guild.id)
+        self.protocol._replay_spool(guild)
 
     def _update_channel_presence(self, guild, channel, member=None, *, relay_modes=False):
         """
@@ -294,6 +1274,8 @@ class DiscordBotPlugin(Plugin):
             ])
         else:
             return
+        pylink_netobj.nick_index.update(uid, member.name, member.user.username)
+
         # Update user presence
         self._update_user_status(guild, uid, member.user.presence)
 
@@ -303,12 +1285,28 @@ class DiscordBotPlugin(Plugin):
                 self._update_channel_presence(guild, channel, member)
         return pylink_user
 
+    def _should_sync_members(self, guild):
+        """
+        Returns whether the full member list should be requested for the given guild.
+        """
+        sync_guild_members = self.protocol.serverdata.get('sync_guild_members', True)
+        if sync_guild_members == 'configured':
+            return guild.id in self.protocol.serverdata.get('guilds', {})
+        return bool(sync_guild_members)
+
     @Plugin.listen('GuildCreate')
+    @timed_listener
     def on_server_connect(self, event: events.GuildCreate, *args, **kwargs):
         log.info('(%s) got GuildCreate event for guild %s/%s', self.protocol.name, event.guild.id, event.guild.name)
+        # disco's own member syncing is disabled in PyLinkDiscordProtocol._get_state_config(),
+        # so that we can skip guilds that aren't configured for relay
+        if self._should_sync_members(event.guild):
+            log.debug('(%s) requesting member list for guild %s/%s', self.protocol.name, event.guild.id, event.guild.name)
+            event.guild.sync()
         self._burst_guild(event.guild)
 
     @Plugin.listen('GuildUpdate')
+    @timed_listener
     def on_server_update(self, event: events.GuildUpdate, *args, **kwargs):
         log.info('(%s) got GuildUpdate event for guild %s/%s', self.protocol.name, event.guild.id, event.guild.name)
         try:
@@ -320,11 +1318,13 @@ class DiscordBotPlugin(Plugin):
             pylink_netobj._guild_name = event.guild.name
 
     @Plugin.listen('GuildDelete')
+    @timed_listener
     def on_server_delete(self, event: events.GuildDelete, *args, **kwargs):
         log.info('(%s) Got kicked from guild %s, triggering a disconnect', self.protocol.name, event.id)
         self.protocol._remove_child(event.id)
 
     @Plugin.listen('GuildMembersChunk')
+    @timed_listener
     def on_member_chunk(self, event: events.GuildMembersChunk, *args, **kwargs):
         log.debug('(%s) got GuildMembersChunk event for guild %s/%s: %s', self.protocol.name, event.guild.id, event.guild.name, event.members)
         try:
@@ -337,6 +1337,7 @@ class DiscordBotPlugin(Plugin):
             self._burst_new_client(event.guild, member, pylink_netobj)
 
     @Plugin.listen('GuildMemberAdd')
+    @timed_listener
     def on_member_add(self, event: events.GuildMemberAdd, *args, **kwargs):
         log.info('(%s) got GuildMemberAdd event for guild %s/%s: %s', self.protocol.name, event.guild.id, event.guild.name, event.member)
         try:
@@ -344,9 +1345,11 @@ class DiscordBotPlugin(Plugin):
         except KeyError:
             log.error("(%s) Could not burst user %s as the parent network object does not exist", self.protocol.name, event.member)
             return
+        pylink_netobj.mention_renderer.invalidate('user', event.member.id)
         self._burst_new_client(event.guild, event.member, pylink_netobj)
 
     @Plugin.listen('GuildMemberUpdate')
+    @timed_listener
     def on_member_update(self, event: events.GuildMemberUpdate, *args, **kwargs):
         log.info('(%s) got GuildMemberUpdate event for guild %s/%s: %s', self.protocol.name, event.guild.id, event.guild.name, event.member)
         try:
@@ -356,6 +1359,7 @@ class DiscordBotPlugin(Plugin):
             return
 
         uid = event.member.id
+        pylink_netobj.mention_renderer.invalidate('user', uid)
         pylink_user = pylink_netobj.users.get(uid)
         if not pylink_user:
             self._burst_new_client(event.guild, event.member, pylink_netobj)
@@ -366,6 +1370,7 @@ class DiscordBotPlugin(Plugin):
         if pylink_user.nick != event.member.name:
             pylink_user.nick = event.member.name
             pylink_netobj.call_hooks([uid, 'NICK', {'newnick': event.member.name, 'oldnick': oldnick}])
+        pylink_netobj.nick_index.update(uid, event.member.name, event.member.user.username)
 
         # Relay permission changes as modes
         for channel in event.guild.channels.values():
@@ -373,6 +1378,7 @@ class DiscordBotPlugin(Plugin):
                 self._update_channel_presence(event.guild, channel, event.member, relay_modes=True)
 
     @Plugin.listen('GuildMemberRemove')
+    @timed_listener
     def on_member_remove(self, event: events.GuildMemberRemove, *args, **kwargs):
         log.info('(%s) got GuildMemberRemove event for guild %s: %s', self.protocol.name, event.guild_id, event.user)
         try:
@@ -381,21 +1387,45 @@ class DiscordBotPlugin(Plugin):
             log.debug("(%s) Could not remove user %s as the parent network object does not exist", self.protocol.name, event.user)
             return
 
+        pylink_netobj.nick_index.remove(event.user.id)
+        pylink_netobj.mention_renderer.invalidate('user', event.user.id)
         if event.user.id in pylink_netobj.users:
             pylink_netobj._remove_client(event.user.id)
             # XXX: make the message configurable
             pylink_netobj.call_hooks([event.user.id, 'QUIT', {'text': 'User left the guild'}])
 
     @Plugin.listen('WebhooksUpdate')
+    @timed_listener
     def on_webhooks_update(self, event):
         if event.channel_id in self.protocol.webhooks:
             log.info('(%s) Invalidating webhook %s due to webhook update on guild %s/channel %s',
                       self.protocol.name, self.protocol.webhooks[event.channel_id], event.guild_id, event.channel_id)
             del self.protocol.webhooks[event.channel_id]
 
+    @Plugin.listen('GuildRoleUpdate')
+    @timed_listener
+    def on_role_update(self, event):
+        pylink_netobj = self.protocol._children.get(event.guild_id)
+        if pylink_netobj:
+            pylink_netobj.mention_renderer.invalidate('role', event.role.id)
+
+    @Plugin.listen('GuildRoleDelete')
+    @timed_listener
+    def on_role_delete(self, event):
+        pylink_netobj = self.protocol._children.get(event.guild_id)
+        if pylink_netobj:
+            pylink_netobj.mention_renderer.invalidate('role', event.role_id)
+
+    def _invalidate_channel_mention(self, channel_id):
+        # Channel mentions can refer to channels in other guilds, so check all of them
+        for pylink_netobj in self.protocol._children.values():
+            pylink_netobj.mention_renderer.invalidate('channel', channel_id)
+
     @Plugin.listen('ChannelCreate')
     @Plugin.listen('ChannelUpdate')
+    @timed_listener
     def on_channel_update(self, event):
+        self._invalidate_channel_mention(event.channel.id)
         # XXX: disco should be doing this for us?!
         if event.overwrites:
             log.debug('discord: resetting channel overrides on %s/%s: %s', event.channel.id, event.channel, event.overwrites)
@@ -404,8 +1434,11 @@ class DiscordBotPlugin(Plugin):
         self._update_channel_presence(event.channel.guild, event.channel, relay_modes=True)
 
     @Plugin.listen('ChannelDelete')
+    @timed_listener
     def on_channel_delete(self, event, *args, **kwargs):
         channel = event.channel
+        self._invalidate_channel_mention(channel.id)
+        self.protocol._inbound_buckets.pop(channel.id, None)
         try:
             pylink_netobj = self.protocol._children[event.channel.guild_id]
         except KeyError:
@@ -429,13 +1462,19 @@ class DiscordBotPlugin(Plugin):
         return common
 
     @Plugin.listen('MessageCreate')
+    @timed_listener
     def on_message(self, event: events.MessageCreate):
-        message = event.message
+        self._relay_message(event.message)
+
+    def _relay_message(self, message, edited=False):
+        """
+        Relays a new or edited Discord message as PRIVMSGs from its author.
+        """
         subserver = None
         target = None
 
-        # If the bot is the one sending the message, don't do anything
-        if message.author.id == self.me.id:
+        # If the bot (or one of our sender accounts) is the one sending the message, don't do anything
+        if message.author.id == self.me.id or self.protocol.is_sender_account(message.author.id):
             return
         elif message.webhook_id:  # Ignore messages from other webhooks for now...
             return
@@ -498,17 +1537,10 @@ class DiscordBotPlugin(Plugin):
             subserver = message.guild.id
             target = message.channel.id
 
-            def format_user_mentions(u):
-                # Try to find the user's guild nick, falling back to the user if that fails
-                if message.guild and u.id in message.guild.members:
-                    return '@' + message.guild.members[u.id].name
-                else:
-                    return '@' + str(u)
-
             # Translate mention IDs to their names
-            text = message.replace_mentions(user_replace=format_user_mentions,
-                                            role_replace=lambda r: '@' + str(r),
-                                            channel_replace=str)
+            text = self.protocol._children[subserver].mention_renderer.render(message)
+            if self.protocol.serverdata.get('discord_markdown', 'irc') == 'irc':
+                text = discord_to_irc(text)
 
         if not subserver:
             return
@@ -516,16 +1548,83 @@ class DiscordBotPlugin(Plugin):
         pylink_netobj = self.protocol._children[subserver]
         author = message.author.id
 
-        def _send(text):
-            for line in text.split('\n'):  # Relay multiline messages as such
-                pylink_netobj.call_hooks([author, 'PRIVMSG', {'target': target, 'text': line}])
-
-        _send(text)
-        # For attachments, just send the link
+        # Relay multiline messages as such. For attachments, just send the link
+        lines = text.split('\n')
         for attachment in message.attachments.values():
-            _send(attachment.url)
+            lines.append(attachment.url)
+
+        previous = self.protocol.message_index.get(message.id)
+        self.protocol.message_index[message.id] = (hash(message.content), tuple(lines))
+        if edited and message.guild:
+            if previous and pylink_netobj.serverdata.get('edit_relay', 'full') == 'changed':
+                # Only relay lines that weren't in the last version of the message
+                old_lines = set(previous[1])
+                lines = [line for line in lines if line not in old_lines]
+                if not lines:
+                    self.protocol.metrics.inc('discord_message_edits_total', result='no_new_lines')
+                    return
+                self.protocol.metrics.inc('discord_message_edits_total', result='changed_lines')
+            else:
+                self.protocol.metrics.inc('discord_message_edits_total', result='full')
+
+            # Optionally, allow marking edited channel messages as such.
+            editmsg_format = pylink_netobj.serverdata.get('editmsg_format')
+            if editmsg_format:
+                try:
+                    lines[0] = editmsg_format % lines[0]
+                except TypeError:
+                    log.warning('(%s) Invalid editmsg_format format, it should contain a %%s', pylink_netobj.name)
+
+        if message.guild:
+            lines = self._shape_lines(pylink_netobj, target, lines)
+
+        for line in lines:
+            pylink_netobj.call_hooks([author, 'PRIVMSG', {'target': target, 'text': line}])
+
+    def _shape_lines(self, pylink_netobj, channel_id, lines):
+        """
+        Returns the lines of a channel message to relay: at most inbound_max_lines lines per message, and
+        inbound_burst lines per channel refilled at inbound_rate lines per second (both off by default). Lines
+        over the limit are collapsed into a "(N more lines)" summary, which takes the place of the last line
+        allowed and links to the full message if a paste store is available.
+        """
+        serverdata = pylink_netobj.serverdata
+        allowed = len(lines)
+        max_lines = serverdata.get('inbound_max_lines', 0)
+        if max_lines:
+            allowed = min(allowed, max_lines)
+
+        rate = serverdata.get('inbound_rate', 0)
+        if rate:
+            burst = serverdata.get('inbound_burst', 20)
+            bucket = self.protocol._inbound_buckets.get(channel_id)
+            if bucket is None or bucket.capacity != burst or bucket.rate != rate:
+                bucket = self.protocol._inbound_buckets[channel_id] = TokenBucket(burst, rate)
+            # The first line of a message is always relayed, as it would be for an IRC user
+            allowed = max(1, bucket.take(allowed))
+
+        metrics = self.protocol.metrics
+        if allowed >= len(lines):
+            metrics.inc('discord_inbound_lines_total', len(lines), result='relayed')
+            return lines
+
+        keep = max(1, allowed - 1)  # The summary counts as one of the allowed lines
+        omitted = len(lines) - keep
+        url = self.protocol._add_paste('\n'.join(lines)) if serverdata.get('inbound_paste') else None
+        if url:
+            summary = '(%d more lines: %s)' % (omitted, url)
+        else:
+            summary = '(%d more lines)' % omitted
+        log.debug('(%s) Collapsing %d of %d lines from message to %s', pylink_netobj.name, omitted, len(lines),
+                  channel_id)
+
+        metrics.inc('discord_inbound_lines_total', keep, result='relayed')
+        metrics.inc('discord_inbound_lines_total', omitted, result='collapsed')
+        metrics.inc('discord_inbound_shaped_messages_total', mode='paste' if url else 'summary')
+        return lines[:keep] + [summary]
 
     @Plugin.listen('MessageUpdate')
+    @timed_listener
     def on_message_update(self, event):
         message = event.message
         if not message.content:
@@ -534,17 +1633,15 @@ class DiscordBotPlugin(Plugin):
             log.debug('discord: Ignoring message update for %s since the content has not been changed', message)
             return
 
-        if message.guild:
-            # Optionally, allow marking edited channel messages as such.
-            subserver = message.guild.id
-            pylink_netobj = self.protocol._children[subserver]
-            editmsg_format = pylink_netobj.serverdata.get('editmsg_format')
-            if editmsg_format:
-                try:
-                    message.content = editmsg_format % message.content
-                except TypeError:
-                    log.warning('(%s) Invalid editmsg_format format, it should contain a %%s', pylink_netobj.name)
-        return self.on_message(event)
+        # Updates can also resend unchanged content (e.g. when a message is pinned or gets an embed),
+        # so drop them before doing any other work.
+        previous = self.protocol.message_index.get(message.id)
+        if previous and previous[0] == hash(message.content):
+            log.debug('discord: Ignoring message update for %s since the content is the same as before', message.id)
+            self.protocol.metrics.inc('discord_message_edits_total', result='unchanged')
+            return
+
+        self._relay_message(message, edited=True)
 
     def _update_user_status(self, guild, uid, presence):
         """Handles a Discord presence update."""
@@ -586,6 +1683,7 @@ class DiscordBotPlugin(Plugin):
             pylink_netobj.call_hooks([uid, 'AWAY', {'text': awaymsg, 'now_invisible': now_invisible}])
 
     @Plugin.listen('PresenceUpdate')
+    @timed_listener
     def on_presence_update(self, event):
         self._update_user_status(event.guild, event.presence.user.id, event.presence)
 
@@ -615,6 +1713,12 @@ class DiscordServer(ClientbotBaseProtocol):
         self.servers[self.sid] = Server(self, None, str(server_id), internal=False, desc=guild_name)
 
         self.join_offline_users = self.serverdata.get('join_offline_users', True)
+        self.nick_index = NickIndex()
+        self.mention_renderer = MentionRenderer(self.guild, maxsize=parent.serverdata.get('mention_cache_size', 1000))
+        # Set while relay_clientbot is forwarding queued messages back to us (see _send_batch) or handling other
+        # CLIENTBOT_* hooks (see call_hooks): the lane to use, and the QueuedMessage being forwarded
+        self._forwarding_lane = None
+        self._forwarded_message = None
         self.protocol_caps |= {'freeform-nicks', 'virtual-server'}
         self.protocol_caps -= {'can-manage-bot-channels'}
 
@@ -690,9 +1794,90 @@ class DiscordServer(ClientbotBaseProtocol):
         """Returns whether the given UID is an internal PyLink client."""
         return uid == self.bot_plugin.me.id or super().is_internal_client(uid, **kwargs)
 
+    def call_hooks(self, hook_args):
+        """Calls the hook handlers for the given hook."""
+        # relay_clientbot handles relayed joins, parts, quits, etc. (CLIENTBOT_* hooks) by sending lines from the
+        # PyLink client. These are relayed traffic, so keep them out of the priority lane used for replies.
+        if self._forwarding_lane is None and hook_args[1].startswith('CLIENTBOT_'):
+            self._forwarding_lane = 'relay'
+            try:
+                return self._call_hooks(hook_args)
+            finally:
+                self._forwarding_lane = None
+        return self._call_hooks(hook_args)
+
+    def _call_hooks(self, hook_args):
+        """Calls the hook handlers for the given hook, timing them if listener profiling is enabled."""
+        threshold = self.virtual_parent.get_slow_handler_threshold()
+        if threshold is None:
+            return super().call_hooks(hook_args)
+
+        start = time.monotonic()
+        try:
+            return super().call_hooks(hook_args)
+        finally:
+            elapsed = time.monotonic() - start
+            self.virtual_parent.metrics.observe('discord_hook_seconds', elapsed, hook=hook_args[1])
+            if elapsed >= threshold:
+                log.warning('(%s) Slow hook dispatch: %s from %s took %.3f seconds (args: %.200s)', self.name,
+                            hook_args[1], hook_args[0], elapsed, hook_args[2])
+
+    # "nick: text", "nick, text" or "@nick text" at the start of a message, optionally after a relay_clientbot
+    # style "<sender> " prefix
+    _highlight_re = re.compile(r'^(?P<prefix>(?:[^<>]*<[^<>]+> )?)(?P<nick>[^\s:,<>@]+)(?=[:,](?:\s|$))')
+    _at_mention_re = re.compile(r'^(?P<prefix>(?:[^<>]*<[^<>]+> )?)@(?P<nick>[^\s@<>:,]+)')
+
+    def _find_member(self, nick):
+        """
+        Returns the member ID for the given nick and how many trailing characters of it are not part of the
+        name (such as punctuation), or (None, 0).
+        """
+        if nick.casefold() in ('everyone', 'here'):  # These are handled by allow_mention_everyone
+            return None, 0
+        name = nick
+        while name:
+            uid = self.nick_index.lookup(name)
+            # Also try nicks as shown by relay, e.g. "nick/network"
+            if uid is None and '/' in name:
+                uid = self.nick_index.lookup(name.rsplit('/', 1)[0])
+            if uid is not None:
+                return uid, len(nick) - len(name)
+            if name[-1] not in '.!?)\'"':
+                break
+            name = name[:-1]
+        return None, 0
+
+    def _resolve_mentions(self, text, allow_mention_everyone=False):
+        """
+        Turns a leading "nick:", "nick," or "@nick" in the text into a Discord mention, if the nick matches
+        exactly one guild member. If allow_mention_everyone is True, a leading "everyone:" or "here:" is
+        turned into an @everyone or @here mention.
+        """
+        if ':' in text or ',' in text:
+            match = self._highlight_re.match(text)
+            if match:
+                nick = match.group('nick')
+                if nick.casefold() in ('everyone', 'here'):
+                    if allow_mention_everyone:
+                        return '%s@%s%s' % (match.group('prefix'), nick.casefold(), text[match.end():])
+                    return text
+                uid, extra = self._find_member(nick)
+                if uid is not None and not extra:
+                    return '%s<@%s>%s' % (match.group('prefix'), uid, text[match.end():])
+        if '@' in text:
+            match = self._at_mention_re.match(text)
+            if match:
+                uid, extra = self._find_member(match.group('nick'))
+                if uid is not None:
+                    nick = match.group('nick')
+                    return '%s<@%s>%s%s' % (match.group('prefix'), uid, nick[len(nick) - extra:],
+                                            text[match.end():])
+        return text
+
     def message(self, source, target, text, notice=False):
         """Sends messages to the target."""
-        if target in self.virtual_parent.client.state.users:
+        is_dm = target in self.virtual_parent.client.state.users
+        if is_dm:
             try:
                 discord_target = self.bot_plugin._dm_channels[target]
                 log.debug('(%s) Found DM channel for %s: %s', self.name, target, discord_target)
@@ -713,11 +1898,33 @@ class DiscordServer(ClientbotBaseProtocol):
         elif text.startswith('\x01'):
             return  # Drop other CTCPs
 
+        if not is_dm and self.virtual_parent.serverdata.get('resolve_mentions', False):
+            text = self._resolve_mentions(text, self.virtual_parent.serverdata.get('allow_mention_everyone', False))
+
         sourceobj = None
         if self.pseudoclient and self.pseudoclient.uid != source:
             sourceobj = self.users.get(source)
 
-        message_data = QueuedMessage(discord_target, target, text, sender=sourceobj, is_notice=notice)
+        # Send DMs and replies from the PyLink client ahead of relayed traffic. Lines that relay_clientbot
+        # sends through the PyLink client keep the lane of the original message, or use the relay lane.
+        if self._forwarding_lane:
+            lane = self._forwarding_lane
+        elif is_dm or sourceobj is None:
+            lane = 'priority'
+        elif notice:
+            lane = 'notice'
+        else:
+            lane = 'relay'
+
+        message_data = QueuedMessage(discord_target, target, text, sender=sourceobj, is_notice=notice, lane=lane)
+        # DMs are not spooled, to avoid keeping private messages on disk. Forwarded lines take over the spool
+        # record of the original message, so that it stays pending until they are sent.
+        spool = self.virtual_parent.spool
+        forwarded = self._forwarded_message
+        if forwarded is not None:
+            message_data.spool_id, forwarded.spool_id = forwarded.spool_id, None
+        elif spool and spool.is_open and discord_target.guild_id:
+            spool.append(message_data, discord_target.guild_id)
         self.virtual_parent.message_queue.put_nowait(message_data)
 
     def join(self, client, channel):
@@ -758,7 +1965,7 @@ class DiscordServer(ClientbotBaseProtocol):
         return [text]
 
 class QueuedMessage:
-    def __init__(self, channel, pylink_target, text, sender=None, is_notice=False):
+    def __init__(self, channel, pylink_target, text, sender=None, is_notice=False, lane='relay'):
         """
         Creates a queued message for Discord.
 
@@ -767,12 +1974,21 @@ class QueuedMessage:
         text: the message text (str)
         sender: optionally, a PyLink User object corresponding to the sender
         is_notice: whether this message corresponds to an IRC notice (bool)
+        lane: the outbound queue lane to use; one of MessageQueue.LANES (str)
         """
         self.channel = channel
         self.pylink_target = pylink_target
         self.text = text
+        # The text before it was translated to Discord markdown by the message builder
+        self.raw_text = text
         self.sender = sender
         self.is_notice = is_notice
+        self.lane = lane
+        self.queued_at = time.monotonic()
+        # For "lines omitted" summaries created by MessageQueue: the amount of lines omitted
+        self.omitted = 0
+        # Set by MessageSpool.append()
+        self.spool_id = None
 
 class PyLinkDiscordProtocol(PyLinkNetworkCoreWithUtils):
     S2S_BUFSIZE = 0
@@ -784,7 +2000,8 @@ class PyLinkDiscordProtocol(PyLinkNetworkCoreWithUtils):
             raise ProtocolError("No API token defined under server settings")
 
         client_config = ClientConfig({'token': self.serverdata['token'],
-                                      'max_reconnects': 0})
+                                      'max_reconnects': 0,
+                                      'state': self._get_state_config()})
         self.client = Client(client_config)
 
         bot_config = BotConfig()
@@ -794,10 +2011,249 @@ class PyLinkDiscordProtocol(PyLinkNetworkCoreWithUtils):
         self.bot.add_plugin(self.bot_plugin)
 
         self._children = {}
-        self.message_queue = queue.Queue()
+        try:
+            self.message_queue = MessageQueue(maxsize=self.serverdata.get('message_queue_size', 5000),
+                                              channel_maxsize=self.serverdata.get('message_queue_channel_size', 500),
+                                              policy=self.serverdata.get('message_queue_overflow', 'drop_oldest'),
+                                              ttl=self.serverdata.get('message_queue_ttl', 0),
+                                              on_overflow=self._on_queue_overflow)
+        except ValueError as e:
+            raise ProtocolError("Invalid message_queue_overflow setting: %s" % e)
+        self.spool = None
+        # Guild ID -> spooled messages from a previous run, to send once the guild is available
+        self._spool_replay = collections.defaultdict(list)
+        if self.serverdata.get('spool'):
+            self.spool = MessageSpool(self.serverdata.get('spool_file') or
+                                      conf.get_database_name('discord-spool-%s' % self.name),
+                                      ttl=self.serverdata.get('spool_ttl', 3600))
+        # Discord channel -> amount of messages dropped since the last overflow report
+        self._queue_overflows = collections.Counter()
+        self._queue_overflow_reported = {}
+        # Channel or webhook ID -> times of recent 429 responses
+        self._ratelimit_hits = collections.defaultdict(collections.deque)
+        # Channel ID -> time when the channel switched to compact mode
+        self._compact_channels = {}
+        # Discord channel ID -> TokenBucket limiting lines relayed from it
+        self._inbound_buckets = {}
+        # Paste ID -> text of shaped incoming messages, served by the local HTTP endpoint
+        self.pastes = LRUCache(maxsize=self.serverdata.get('paste_store_size', 100))
+        # Discord message ID -> (content hash, lines last relayed), used to filter message edits
+        self.message_index = LRUCache(maxsize=self.serverdata.get('message_index_size', 5000))
         self.webhooks = {}
         self._message_thread = None
 
+        self.metrics = DiscordMetrics()
+        for lane in MessageQueue.LANES:
+            self.metrics.set_function('discord_message_queue_depth', functools.partial(self.message_queue.lane_size, lane),
+                                      lane=lane)
+        self.metrics.set_function('discord_compact_channels', self._compact_channels.__len__)
+        self.metrics.set_function('discord_paste_store_size', self.pastes.__len__)
+        self.hub_monitor = None
+
+        # Sends to guild channels are spread over the main bot account and any extra sender accounts
+        self.senders = [SenderClient('main', self.client.api)]
+        for idx, token in enumerate(self.serverdata.get('sender_tokens') or [], start=1):
+            # The guilds each sender is in are looked up on connect
+            self.senders.append(SenderClient('sender%d' % idx, APIClient(token, client=self.client), guild_ids=set()))
+        self._sender_rotation = itertools.count()
+        for sender in self.senders:
+            labels = {'client': sender.name} if sender.guild_ids is not None else {}
+            adapter = self._configure_http_session(sender.api.http, **labels)
+            if sender is self.senders[0]:
+                self._http_adapter = adapter
+            self._instrument_http(sender.api.http, sender)
+        self._http_server = None
+
+    # Matches the parts of REST API paths that vary per request, so that metrics can be grouped by route
+    _webhook_token_re = re.compile(r'/webhooks/(\d+)/[^/]+')
+    _snowflake_re = re.compile(r'/\d+')
+    # Matches the channel or webhook ID that a REST API path acts on
+    _resource_id_re = re.compile(r'/(?:channels|webhooks)/(\d+)')
+
+    @classmethod
+    def _get_route_name(cls, url):
+        """
+        Returns a route template for the given API URL, e.g. /channels/:id/messages. Webhook tokens are
+        always stripped.
+        """
+        path = urllib.parse.urlparse(url).path
+        path = path.split('/api', 1)[-1]
+        if path.startswith('/v') and '/' in path[1:]:  # Strip the API version
+            path = path[path.index('/', 1):]
+        path = cls._webhook_token_re.sub(r'/webhooks/\1/:token', path)
+        return cls._snowflake_re.sub('/:id', path)
+
+    def _configure_http_session(self, http, **labels):
+        """
+        Mounts a pooled transport adapter on the requests session used by the given disco HTTPClient, using the
+        http_pool_size, http_keepalive and http_*_timeout options. Returns the adapter.
+
+        labels are added to the connection metrics for this session.
+        """
+        socket_options = None
+        if self.serverdata.get('http_keepalive', True):
+            socket_options = list(urllib3.connection.HTTPConnection.default_socket_options)
+            socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            # These are Linux specific
+            keepalive_idle = self.serverdata.get('http_keepalive_idle', 60)
+            for option, value in (('TCP_KEEPIDLE', keepalive_idle), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)):
+                if hasattr(socket, option):
+                    socket_options.append((socket.IPPROTO_TCP, getattr(socket, option), value))
+
+        pool_size = self.serverdata.get('http_pool_size', 10)
+        adapter = PooledHTTPAdapter(socket_options=socket_options, pool_connections=pool_size,
+                                    pool_maxsize=pool_size)
+        for prefix in ('https://', 'http://'):
+            http.session.mount(prefix, adapter)
+        self._http_timeout = (self.serverdata.get('http_connect_timeout', 10),
+                              self.serverdata.get('http_read_timeout', 30))
+
+        self.metrics.set_function('discord_http_connections_opened', lambda: adapter.get_pool_stats()[0], **labels)
+        self.metrics.set_function('discord_http_connection_reuse_ratio', adapter.get_reuse_ratio, **labels)
+        return adapter
+
+    def _instrument_http(self, http, sender=None):
+        """
+        Wraps the requests session used by the given disco HTTPClient to collect per-route metrics.
+        If sender is given, rate limits are also tracked for that SenderClient.
+        """
+        session_request = http.session.request
+
+        def request(method, url, *args, **kwargs):
+            route = self._get_route_name(url)
+            kwargs.setdefault('timeout', self._http_timeout)
+            start = time.monotonic()
+            try:
+                response = session_request(method, url, *args, **kwargs)
+            except Exception:
+                self.metrics.inc('discord_http_errors_total', method=method, route=route)
+                raise
+            self.metrics.observe('discord_http_request_seconds', time.monotonic() - start, method=method, route=route)
+            # Time between sending the request and receiving the response headers
+            self.metrics.observe('discord_http_ttfb_seconds', response.elapsed.total_seconds(), method=method, route=route)
+            self.metrics.inc('discord_http_requests_total', method=method, route=route, status=response.status_code)
+            if response.status_code == 429:
+                self.metrics.inc('discord_http_ratelimited_total', method=method, route=route)
+                retry_after = response.headers.get('Retry-After') or response.headers.get('X-RateLimit-Reset-After')
+                try:
+                    self.metrics.observe('discord_http_retry_after_seconds', float(retry_after), route=route)
+                except (TypeError, ValueError):
+                    pass
+                log.debug('(%s) Rate limited on %s %s (retry after %s)', self.name, method, route, retry_after)
+
+                match = self._resource_id_re.search(url)
+                if match:
+                    self._ratelimit_hits[int(match.group(1))].append(time.monotonic())
+                if sender:
+                    sender.ratelimit_hits.append(time.monotonic())
+                    self.metrics.inc('discord_sender_ratelimited_total', client=sender.name)
+            return response
+
+        http.session.request = request
+
+    def _start_hub_monitor(self):
+        """
+        Starts the gevent hub block monitor, if enabled. The monitor is shared by all Discord networks,
+        since they all run on the same hub.
+        """
+        global _hub_monitor
+        threshold = self.serverdata.get('block_monitor_threshold')
+        if not threshold:
+            return
+        if _hub_monitor is None or not _hub_monitor.running:
+            _hub_monitor = HubBlockMonitor(threshold / 1000)
+            _hub_monitor.start()
+            log.info('(%s) Started gevent hub block monitor with a threshold of %s ms', self.name, threshold)
+        self.hub_monitor = _hub_monitor
+        self.metrics.set_function('discord_hub_blocked_seconds', self.hub_monitor.get_blocked_time)
+
+    def _start_http_server(self):
+        """
+        Starts the local HTTP endpoint for metrics, if one is configured.
+        """
+        listen = self.serverdata.get('http_listen')
+        if not listen:
+            return
+        host, port = str(listen).rsplit(':', 1)
+        self._http_server = WSGIServer((host, int(port)), self._http_app, log=None)
+        self._http_server.start()
+        log.info('(%s) Serving metrics on http://%s:%s/metrics', self.name, host, port)
+
+    def _http_app(self, environ, start_response):
+        """WSGI application for the local HTTP endpoint."""
+        path = environ.get('PATH_INFO', '')
+        if path == '/metrics':
+            start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+            return [self.metrics.render().encode('utf-8')]
+        elif path.startswith('/paste/'):
+            text = self.pastes.get(path[len('/paste/'):])
+            if text is not None:
+                start_response('200 OK', [('Content-Type', 'text/plain; charset=utf-8'),
+                                          ('X-Content-Type-Options', 'nosniff')])
+                return [text.encode('utf-8')]
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'Not found\n']
+
+    def _add_paste(self, text):
+        """
+        Stores text in the paste store and returns its URL, or None if the local HTTP endpoint is not enabled.
+        """
+        if not self._http_server:
+            return None
+        base_url = self.serverdata.get('paste_url')
+        if not base_url:
+            host, port = self._http_server.address[:2]
+            base_url = 'http://%s:%s' % (host, port)
+        # Paste IDs are random so that pastes from other channels can't be enumerated
+        paste_id = secrets.token_urlsafe(6)
+        self.pastes[paste_id] = text
+        return '%s/paste/%s' % (base_url.rstrip('/'), paste_id)
+
+    def get_slow_handler_threshold(self):
+        """
+        Returns the time in seconds after which listeners and hook dispatches are logged as slow,
+        or None if listener profiling is disabled.
+        """
+        if not self.serverdata.get('profile_listeners'):
+            return None
+        return self.serverdata.get('slow_handler_threshold', 0.5)
+
+    def _get_state_config(self):
+        """
+        Returns the options passed to disco's StateConfig.
+
+        We only read guilds, channels, members and users from the state cache, so message tracking
+        is off unless explicitly enabled.
+        """
+        return {
+            'track_messages': self.serverdata.get('track_messages', False),
+            'track_messages_size': self.serverdata.get('track_messages_size', 100),
+            # Member syncing is done per guild in DiscordBotPlugin.on_server_connect
+            'sync_guild_members': False,
+        }
+
+    def get_memory_report(self):
+        """
+        Returns a list of (guild, stats dict) pairs describing what the disco state cache holds
+        for each guild we're in.
+        """
+        state = self.client.state
+        cached_messages = getattr(state, 'messages', {})
+        report = []
+        for guild_id, guild in state.guilds.items():
+            stats = {
+                'members': len(guild.members),
+                'channels': len(guild.channels),
+                'roles': len(guild.roles),
+                'messages': sum(len(cached_messages.get(channel_id, ())) for channel_id in guild.channels),
+            }
+            pylink_netobj = self._children.get(guild_id)
+            if pylink_netobj:
+                stats['pylink_users'] = len(pylink_netobj.users)
+                stats['pylink_channels'] = len(pylink_netobj.channels)
+            report.append((guild, stats))
+        return report
+
     @staticmethod
     def is_nick(s, nicklen=None):
         return True
@@ -857,7 +2313,9 @@ class PyLinkDiscordProtocol(PyLinkNetworkCoreWithUtils):
         if channel.id in self.webhooks:  # We've already saved this webhook
             wh = self.webhooks[channel.id]
             log.debug('discord: Using saved webhook %s (%s) for channel %s', wh.id, wh.name, channel)
+            self.metrics.inc('discord_webhook_cache_total', result='hit')
             return wh
+        self.metrics.inc('discord_webhook_cache_total', result='miss')
 
         # Generate a webhook name based off a configurable prefix and the channel ID
         webhook_name = '%s-%d' % (self.serverdata.get('webhook_name') or 'PyLinkRelay', channel.id)
@@ -883,6 +2341,7 @@ class PyLinkDiscordProtocol(PyLinkNetworkCoreWithUtils):
             nettag: The short network tag of the network 'user' belongs to
             avatar: The URL to the user's avatar (str), or None if no avatar is specified
         """
+        netobj = user._irc
         # Try to lookup the remote user data via relay metadata
         if hasattr(user, 'remote'):
             remotenet, remoteuid = user.remote
@@ -926,111 +2385,521 @@ class PyLinkDiscordProtocol(PyLinkNetworkCoreWithUtils):
         return fields
 
     MAX_MESSAGE_SIZE = 2000
-    def _message_builder(self):
+    MAX_EMBED_SIZE = 4096
+    def _get_channel_serverdata(self, channel):
         """
-        Discord message queue handler. Also supports virtual users via webhooks.
+        Returns the serverdata that applies to the given Discord channel: the guild's for guild channels,
+        and ours for DMs.
+        """
+        if channel.guild_id in self._children:
+            return self._children[channel.guild_id].serverdata
+        return self.serverdata
+
+    def _pack_message(self, text, serverdata):
+        """
+        Returns the message fields (content, embed, attachment) to send the given text with.
+
+        If pack_messages is enabled, text longer than a normal message is sent as an embed description,
+        or if it is longer than pack_attachment_threshold, as a .txt attachment with a short preview.
+        Otherwise, the text is truncated to MAX_MESSAGE_SIZE.
+        """
+        if len(text) <= self.MAX_MESSAGE_SIZE or not serverdata.get('pack_messages'):
+            return {'content': text[:self.MAX_MESSAGE_SIZE]}
+
+        attachment_threshold = min(serverdata.get('pack_attachment_threshold', self.MAX_EMBED_SIZE), self.MAX_EMBED_SIZE)
+        if len(text) <= attachment_threshold:
+            self.metrics.inc('discord_packed_messages_total', type='embed')
+            return {'embed': MessageEmbed(description=text)}
+
+        self.metrics.inc('discord_packed_messages_total', type='attachment')
+        lines = text.split('\n')
+        preview = '\n'.join(lines[:PACK_PREVIEW_LINES])[:self.MAX_MESSAGE_SIZE // 2]
+        return {'content': '%s\n(%d lines, full text attached)' % (preview, len(lines)),
+                'attachment': ('messages.txt', text.encode('utf-8'))}
+
+    def _execute_webhook(self, webhook, username, avatar_url, content=None, embed=None, attachment=None):
+        """
+        Sends a message through the given webhook, optionally with an embed and a file attachment.
+
+        This calls the REST API through our pooled HTTP client directly instead of using disco's
+        Webhook.execute(), which doesn't support file uploads.
+        """
+        payload = {'username': username}
+        if avatar_url:
+            payload['avatar_url'] = avatar_url
+        if content:
+            payload['content'] = content
+        if embed:
+            payload['embeds'] = [embed.to_dict()]
+
+        route_args = dict(webhook=webhook.id, token=webhook.token)
+        if attachment:
+            self.client.api.http(Routes.WEBHOOKS_TOKEN_EXECUTE, route_args,
+                                 data={'payload_json': json.dumps(payload)}, files={'file': attachment})
+        else:
+            self.client.api.http(Routes.WEBHOOKS_TOKEN_EXECUTE, route_args, json=payload)
+
+    def _init_senders(self):
+        """
+        Looks up the user ID and guilds of each extra sender account.
+        """
+        for sender in self.senders[1:]:
+            try:
+                sender.user_id = sender.api.users_me_get().id
+                guild_ids = set()
+                params = {'limit': 200}
+                while True:  # This endpoint is paginated
+                    guilds = sender.api.http(Routes.USERS_ME_GUILDS_LIST, params=params).json()
+                    guild_ids.update(int(guild['id']) for guild in guilds)
+                    if len(guilds) < params['limit']:
+                        break
+                    params['after'] = guilds[-1]['id']
+            except Exception:
+                log.exception('(%s) Failed to look up guilds for sender account %s; it will not be used',
+                              self.name, sender.name)
+                continue
+            sender.guild_ids = guild_ids
+            log.info('(%s) Sender account %s (%s) is in %d guild(s)', self.name, sender.name, sender.user_id,
+                     len(guild_ids))
+
+    def is_sender_account(self, uid):
+        """Returns whether the given Discord user ID is one of our extra sender accounts."""
+        return any(sender.user_id == uid for sender in self.senders[1:])
+
+    def _get_sender(self, channel):
         """
-        def _send(sender, channel, pylink_target, message_parts):
-            """
-            Wrapper to send a joined message.
-            """
-            text = '\n'.join(message_parts)
-
-            # Handle the case when the sender is not the PyLink client (sender != None)
-            # For channels, use either virtual webhook users or CLIENTBOT_MESSAGE forwarding (relay_clientbot).
-            if sender:
-                user_fields = self._get_webhook_fields(sender)
-
-                if channel.guild:  # This message belongs to a channel
-                    netobj = self._children[channel.guild.id]
-
-                    # Note: skip webhook sending for messages that contain only spaces, as that fails with
-                    # 50006 "Cannot send an empty message" errors
-                    if netobj.serverdata.get('use_webhooks') and text.strip():
-                        user_format = netobj.serverdata.get('webhook_user_format', "$nick @ $netname")
-                        tmpl = string.Template(user_format)
-                        webhook_fake_username = tmpl.safe_substitute(self._get_webhook_fields(sender))
-
-                        try:
-                            webhook = self._get_webhook(channel)
-                            webhook.execute(content=text[:self.MAX_MESSAGE_SIZE], username=webhook_fake_username, avatar_url=user_fields['avatar'])
-                        except APIException as e:
-                            if e.code == 10015 and channel.id in self.webhooks:
-                                log.info("(%s) Invalidating webhook %s for channel %s due to Unknown Webhook error (10015)",
-                                         self.name, self.webhooks[channel.id], channel)
-                                del self.webhooks[channel.id]
-                            elif e.code == 50013:
-                                # Prevent spamming errors: disable webhooks we don't have the right permissions
-                                log.warning("(%s) Disabling webhooks on guild %s/%s due to insufficient permissions (50013). Rehash to re-enable.",
-                                            self.name, channel.guild.id, channel.guild.name)
-                                self.serverdata.update(
-                                    {'guilds':
-                                        {channel.guild.id:
-                                            {'use_webhooks': False}
-                                        }
-                                    })
-                            else:
-                                log.error("(%s) Caught API exception when sending webhook message to channel %s: %s/%s", self.name, channel, e.response.status_code, e.code)
-                            log.debug("(%s) APIException full traceback:", self.name, exc_info=True)
-
-                        except:
-                            log.exception("(%s) Failed to send webhook message to channel %s", self.name, channel)
+        Returns the SenderClient to send the next message to the given channel with. Accounts that can send to
+        the channel are used in turn, skipping those that were rate limited recently if possible.
+        """
+        candidates = [sender for sender in self.senders if sender.can_send(channel)]
+        if len(candidates) == 1:
+            return candidates[0]
+        start = next(self._sender_rotation) % len(candidates)
+        candidates = candidates[start:] + candidates[:start]
+        # min() returns the first of equal items, so this keeps the rotation order for ties
+        return min(candidates, key=SenderClient.count_recent_ratelimits)
+
+    def _send_batch(self, channel, messages):
+        """
+        Sends a list of QueuedMessages from the same sender to the given Discord channel, as one message.
+        """
+        sender = messages[0].sender
+        pylink_target = messages[-1].pylink_target
+        text = '\n'.join(message.text for message in messages)
+        self.metrics.observe('discord_batch_lines', len(messages), buckets=(1, 2, 5, 10, 20, 50, 100))
+        serverdata = self._get_channel_serverdata(channel)
+
+        # Handle the case when the sender is not the PyLink client (sender != None)
+        # For channels, use either virtual webhook users or CLIENTBOT_MESSAGE forwarding (relay_clientbot).
+        if sender:
+            user_fields = self._get_webhook_fields(sender)
+
+            if channel.guild:  # This message belongs to a channel
+                netobj = self._children[channel.guild.id]
+
+                # Note: skip webhook sending for messages that contain only spaces, as that fails with
+                # 50006 "Cannot send an empty message" errors
+                if netobj.serverdata.get('use_webhooks') and text.strip():
+                    user_format = netobj.serverdata.get('webhook_user_format', "$nick @ $netname")
+                    tmpl = string.Template(user_format)
+                    webhook_fake_username = tmpl.safe_substitute(user_fields)
+
+                    try:
+                        webhook = self._get_webhook(channel)
+                        self._execute_webhook(webhook, webhook_fake_username, user_fields['avatar'],
+                                              **self._pack_message(text, serverdata))
+                    except APIException as e:
+                        if e.code == 10015 and channel.id in self.webhooks:
+                            log.info("(%s) Invalidating webhook %s for channel %s due to Unknown Webhook error (10015)",
+                                     self.name, self.webhooks[channel.id], channel)
+                            del self.webhooks[channel.id]
+                        elif e.code == 50013:
+                            # Prevent spamming errors: disable webhooks we don't have the right permissions
+                            log.warning("(%s) Disabling webhooks on guild %s/%s due to insufficient permissions (50013). Rehash to re-enable.",
+                                        self.name, channel.guild.id, channel.guild.name)
+                            self.serverdata.update(
+                                {'guilds':
+                                    {channel.guild.id:
+                                        {'use_webhooks': False}
+                                    }
+                                })
                         else:
-                            return
+                            log.error("(%s) Caught API exception when sending webhook message to channel %s: %s/%s", self.name, channel, e.response.status_code, e.code)
+                        log.debug("(%s) APIException full traceback:", self.name, exc_info=True)
 
-                    for line in message_parts:
-                        netobj.call_hooks([sender.uid, 'CLIENTBOT_MESSAGE', {'target': pylink_target, 'text': line}])
-                    return
-                else:
-                    # This is a forwarded PM - prefix the message with its sender info.
-                    pm_format = self.serverdata.get('pm_format', "Message from $nick @ $netname: $text")
-                    user_fields['text'] = text
-                    text = string.Template(pm_format).safe_substitute(user_fields)
+                    except:
+                        log.exception("(%s) Failed to send webhook message to channel %s", self.name, channel)
+                    else:
+                        return
+
+                # relay_clientbot formats these lines and sends them back to us from the PyLink client, from within
+                # the hook call. Send the original text, since the message builder will translate it again.
+                netobj._forwarding_lane = messages[0].lane
+                try:
+                    for message in messages:
+                        netobj._forwarded_message = message
+                        netobj.call_hooks([sender.uid, 'CLIENTBOT_MESSAGE',
+                                           {'target': pylink_target, 'text': message.raw_text}])
+                finally:
+                    netobj._forwarding_lane = netobj._forwarded_message = None
+                return
+            else:
+                # This is a forwarded PM - prefix the message with its sender info.
+                pm_format = self.serverdata.get('pm_format', "Message from $nick @ $netname: $text")
+                user_fields['text'] = text
+                text = string.Template(pm_format).safe_substitute(user_fields)
+
+        packed = self._pack_message(text, serverdata)
+        attachments = [packed['attachment']] if 'attachment' in packed else []
+        sender_client = self._get_sender(channel)
+        self.metrics.inc('discord_sender_messages_total', client=sender_client.name)
+        try:
+            sender_client.api.channels_messages_create(channel.id, packed.get('content'), embed=packed.get('embed'),
+                                                       attachments=attachments)
+        except Exception as e:
+            if sender_client is self.senders[0]:
+                log.exception("(%s) Could not send message to channel %s (pylink_target=%s)", self.name, channel, pylink_target)
+                return
 
+            # Retry with the main bot account, so that the message isn't lost because of one sender account.
+            # Sender accounts refused access to the channel (e.g. 403 for missing permissions) aren't used for it
+            # again; other errors (network issues, 5xx) may be transient.
+            self.metrics.inc('discord_sender_failures_total', client=sender_client.name)
+            if isinstance(e, APIException) and 400 <= e.response.status_code < 500 and e.response.status_code != 429:
+                log.warning("(%s) Sender account %s can't send to channel %s (%s/%s); no longer using it there",
+                            self.name, sender_client.name, channel, e.response.status_code, e.code)
+                sender_client.failed_channels.add(channel.id)
+            else:
+                log.warning("(%s) Sender account %s failed to send to channel %s, retrying with the main account",
+                            self.name, sender_client.name, channel, exc_info=True)
+
+            self.metrics.inc('discord_sender_messages_total', client=self.senders[0].name)
             try:
-                channel.send_message(text[:self.MAX_MESSAGE_SIZE])
-            except Exception as e:
+                self.senders[0].api.channels_messages_create(channel.id, packed.get('content'),
+                                                             embed=packed.get('embed'), attachments=attachments)
+            except Exception:
                 log.exception("(%s) Could not send message to channel %s (pylink_target=%s)", self.name, channel, pylink_target)
 
-        joined_messages = collections.defaultdict(collections.deque)
-        while not self._aborted.is_set():
+    def _count_recent_ratelimits(self, channel):
+        """
+        Returns the amount of 429 responses received for the given channel and its webhook in the last
+        COMPACT_RATELIMIT_WINDOW seconds.
+        """
+        cutoff = time.monotonic() - COMPACT_RATELIMIT_WINDOW
+        resource_ids = [channel.id]
+        if channel.id in self.webhooks:
+            resource_ids.append(self.webhooks[channel.id].id)
+
+        count = 0
+        for resource_id in resource_ids:
+            hits = self._ratelimit_hits.get(resource_id)
+            if hits:
+                while hits and hits[0] < cutoff:
+                    hits.popleft()
+                count += len(hits)
+        return count
+
+    def _use_compact_mode(self, channel, messages):
+        """
+        Returns whether messages to the given webhook-enabled channel should be sent in compact mode, where
+        lines from different senders are merged into one message from the bot instead of using one webhook
+        call per sender.
+
+        A channel switches to compact mode when its backlog (the current batch plus queued messages) would take
+        compact_backlog_threshold webhook calls to send (one per run of lines from the same sender), when the oldest message in the batch has waited for longer than
+        compact_delay_threshold seconds, or when compact_ratelimit_threshold 429 responses were received for it
+        in the last COMPACT_RATELIMIT_WINDOW seconds. It switches back once its backlog has drained and it is no
+        longer being rate limited, after at least COMPACT_MIN_DURATION seconds.
+        """
+        if not channel.guild_id:
+            return False
+        netobj = self._children.get(channel.guild_id)
+        if netobj is None:
+            return False
+        serverdata = netobj.serverdata
+        if not serverdata.get('use_webhooks'):
+            return False
+
+        backlog_threshold = serverdata.get('compact_backlog_threshold', 10)
+        delay_threshold = serverdata.get('compact_delay_threshold', 3)
+        ratelimit_threshold = serverdata.get('compact_ratelimit_threshold', 2)
+        # Consecutive lines from one sender are sent in one webhook call anyway, so count sender changes instead
+        # of lines. Otherwise, one user pasting a few lines would turn off webhooks for the channel.
+        queued = itertools.chain(messages, self.message_queue.channel_messages(channel))
+        backlog = sum(1 for _ in itertools.groupby(queued, key=lambda message: message.sender))
+        ratelimits = self._count_recent_ratelimits(channel)
+        now = time.monotonic()
+        delay = now - min(message.queued_at for message in messages)
+
+        since = self._compact_channels.get(channel.id)
+        if since is None:
+            if (backlog_threshold and backlog >= backlog_threshold) or \
+                    (delay_threshold and delay >= delay_threshold) or \
+                    (ratelimit_threshold and ratelimits >= ratelimit_threshold):
+                log.info('(%s) Switching channel %s to compact mode (backlog: %d sender(s)/%.1f s, recent 429s: %d)',
+                         netobj.name, channel, backlog, delay, ratelimits)
+                self.metrics.inc('discord_compact_mode_switches_total', mode='compact')
+                self._compact_channels[channel.id] = now
+                return True
+            return False
+        elif now - since >= COMPACT_MIN_DURATION and \
+                (not backlog_threshold or backlog <= max(backlog_threshold // 2, 1)) and \
+                (not delay_threshold or delay <= delay_threshold / 2) and \
+                (not ratelimit_threshold or not ratelimits):
+            log.info('(%s) Switching channel %s back to webhooks', netobj.name, channel)
+            self.metrics.inc('discord_compact_mode_switches_total', mode='webhooks')
+            del self._compact_channels[channel.id]
+            return False
+        return True
+
+    def _compact_messages(self, channel, messages):
+        """
+        Rewrites the given QueuedMessages in place to be sent by the PyLink client, prefixing each line with its
+        sender (compact_format).
+        """
+        netobj = self._children[channel.guild_id]
+        tmpl = string.Template(netobj.serverdata.get('compact_format', '<$nick> $text'))
+        escape_markdown = self.serverdata.get('escape_markdown', True)
+        sender_fields = {}
+        compacted = 0
+        for message in messages:
+            if message.sender is None:
+                continue
+            compacted += 1
+            if message.sender.uid not in sender_fields:
+                fields = self._get_webhook_fields(message.sender)
+                fields['nick'] = irc_to_discord(fields['nick'], markdown=False, escape_markdown=escape_markdown)
+                sender_fields[message.sender.uid] = fields
+            message.text = tmpl.safe_substitute(sender_fields[message.sender.uid], text=message.text)
+            message.sender = None
+        self.metrics.inc('discord_compact_lines_total', compacted)
+
+    def _flush_messages(self, joined_messages):
+        """
+        Sends out the messages buffered by _message_builder (channel -> lane -> deque of QueuedMessages).
+
+        Channels take turns sending one batch each, starting with the channels that have messages in the highest
+        priority lane; within a channel, higher priority lanes are sent first. Messages queued in the meantime
+        are picked up between turns, so that a busy channel can't hold up other channels or PyLink's replies.
+        """
+        flush_start = time.monotonic()
+        lane_ranks = {lane: rank for rank, lane in enumerate(MessageQueue.LANES)}
+        while joined_messages:
+            if self.spool:
+                # Group commit: make sure everything we're about to send is on disk first
+                sync_start = time.monotonic()
+                self.spool.sync()
+                self.metrics.observe('discord_spool_sync_seconds', time.monotonic() - sync_start)
+
+            turns = []
+            for channel, lanes in joined_messages.items():
+                lane = min((lane for lane, messages in lanes.items() if messages), key=lane_ranks.get)
+                turns.append((lane_ranks[lane], channel, lanes[lane]))
+            turns.sort(key=lambda turn: turn[0])  # This is stable, so channels keep their order otherwise
+
+            for _, channel, messages in turns:
+                self._send_next_batch(channel, messages)
+                if not any(joined_messages[channel].values()):
+                    del joined_messages[channel]
+
+            if self._queue_overflows:
+                self._report_queue_overflows()
+
+            self._refill_buffer(joined_messages)
+
+        self.metrics.observe('discord_flush_seconds', time.monotonic() - flush_start)
+
+    def _refill_buffer(self, joined_messages):
+        """
+        Picks up messages queued while _flush_messages was sending, up to the next batch for each channel and lane.
+        Anything beyond that stays in the message queue, so that its size bounds and TTL still apply to a channel
+        that receives lines faster than they can be sent.
+        """
+        # (lane, channel) -> total length of the buffered messages
+        lengths = {}
+        full = set()
+        for channel, lanes in joined_messages.items():
+            for lane, messages in lanes.items():
+                lengths[(lane, channel)] = sum(len(message.text) + 1 for message in messages)
+                if self._is_full_batch(channel, messages, lengths[(lane, channel)]):
+                    full.add((lane, channel))
+
+        while True:
             try:
-                # message is an instance of QueuedMessage (defined in this file)
-                message = self.message_queue.get(timeout=BATCH_DELAY)
-                message.text = utils.strip_irc_formatting(message.text)
+                message = self.message_queue.get(timeout=0, exclude=full)
+            except queue.Empty:
+                return
+            messages = self._buffer_message(joined_messages, message)
+            key = (message.lane, message.channel)
+            lengths[key] = lengths.get(key, 0) + len(message.text) + 1
+            if self._is_full_batch(message.channel, messages, lengths[key]):
+                full.add(key)
 
-                if not self.serverdata.get('allow_mention_everyone', False):
-                    message.text = message.text.replace('@here', '@ here')
-                    message.text = message.text.replace('@everyone', '@ everyone')
+    def _is_full_batch(self, channel, messages, length):
+        """
+        Returns whether the given deque of buffered QueuedMessages (with the given total length) holds a complete
+        batch for the channel, i.e. _send_next_batch wouldn't take any more messages into it.
+        """
+        if len(messages) > 1 and messages[-1].sender != messages[0].sender and \
+                channel.id not in self._compact_channels:  # Compact mode merges senders
+            return True
+        return length >= self._get_max_batch_size(channel)
+
+    def _get_max_batch_size(self, channel):
+        """Returns the maximum length of the messages sent to the given channel in one batch."""
+        # With message packing, batches can go past the normal message size limit (except for DMs, which
+        # are prefixed using pm_format)
+        serverdata = self._get_channel_serverdata(channel)
+        if channel.guild_id and serverdata.get('pack_messages'):
+            return serverdata.get('pack_max_size', 100000)
+        return self.MAX_MESSAGE_SIZE
+
+    def _send_next_batch(self, channel, messages):
+        """
+        Sends the next batch from the given deque of QueuedMessages for a channel: consecutive messages from
+        the same sender, up to the message size limit.
+        """
+        if self._use_compact_mode(channel, messages):
+            self._compact_messages(channel, messages)
+
+        max_size = self._get_max_batch_size(channel)
+
+        # We group messages here to avoid being throttled as often. In short, we want to send a message when:
+        # 1) The virtual sender (for webhook purposes) changes
+        # 2) We reach the message limit for one batch (2000 chars, or pack_max_size when packing)
+        # 3) We run out of messages at the end
+        batch = [messages.popleft()]
+        length = len(batch[0].text) + 1  # Account for the newline
+        while messages and messages[0].sender == batch[0].sender and length + len(messages[0].text) < max_size:
+            batch.append(messages.popleft())
+            length += len(batch[-1].text) + 1
+
+        self._send_batch(channel, batch)
+        if self.spool:
+            self.spool.ack(message.spool_id for message in batch if message.spool_id)
+
+    def _on_queue_overflow(self, reason, messages):
+        """
+        Callback for messages dropped or expired by the message queue.
+        """
+        for message in messages:
+            self.metrics.inc('discord_queue_overflow_total', reason=reason, lane=message.lane)
+            self._queue_overflows[message.channel] += 1
+        if self.spool:
+            self.spool.ack(message.spool_id for message in messages if message.spool_id)
+        log.debug('(%s) Message queue overflow (%s): %d message(s) removed', self.name, reason, len(messages))
+
+    def _open_spool(self):
+        """
+        Opens the message spool, if enabled, and loads messages left over from a previous run for replay.
+        """
+        if not self.spool or self.spool.is_open:
+            return
+        try:
+            records = self.spool.open()
+        except (OSError, ValueError):
+            log.exception('(%s) Failed to open message spool %s; disabling it', self.name, self.spool.filename)
+            self.spool = None
+            return
+        for record in records:
+            self._spool_replay[record['guild']].append(record)
+        if records:
+            log.info('(%s) Loaded %d unsent message(s) from spool %s', self.name, len(records), self.spool.filename)
+
+    def _replay_spool(self, guild):
+        """
+        Queues spooled messages from a previous run for the given guild, once it is available. Messages from
+        IRC users are prefixed with their nick (using compact_format), since the senders are gone by now.
+        """
+        records = self._spool_replay.pop(guild.id, None)
+        if not records:
+            return
+        netobj = self._children[guild.id]
+        tmpl = string.Template(netobj.serverdata.get('compact_format', '<$nick> $text'))
+        cutoff = time.time() - self.spool.ttl
+        skipped = []
+        replayed = 0
+        for record in records:
+            channel = guild.channels.get(record['channel'])
+            if channel is None or (self.spool.ttl and record['ts'] < cutoff):
+                skipped.append(record['id'])
+                continue
+            text = record['text']
+            if record['nick']:
+                text = tmpl.safe_substitute(nick=record['nick'], text=text)
+            message = QueuedMessage(channel, record['target'], text)
+            message.spool_id = record['id']
+            self.message_queue.put_nowait(message)
+            replayed += 1
+        self.spool.ack(skipped)
+        self.metrics.inc('discord_spool_replayed_total', replayed)
+        log.info('(%s) Replaying %d spooled message(s) for guild %s (%d expired or for unknown channels)',
+                 netobj.name, replayed, guild.id, len(skipped))
+
+    def _report_queue_overflows(self):
+        """
+        Reports dropped messages to each affected guild network by calling the DISCORD_QUEUE_OVERFLOW hook,
+        and (unless queue_overflow_notice is disabled) sending a notice from the guild's server to the channel,
+        which relay forwards to IRC. Each channel is reported at most once every OVERFLOW_REPORT_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        for channel, count in list(self._queue_overflows.items()):
+            if now - self._queue_overflow_reported.get(channel.id, 0) < OVERFLOW_REPORT_INTERVAL:
+                continue
+            del self._queue_overflows[channel]
+            self._queue_overflow_reported[channel.id] = now
+
+            netobj = self._children.get(channel.guild_id)
+            if netobj is None:  # DMs or a guild that is gone
+                continue
+            log.warning('(%s) %d message(s) to %s were dropped due to Discord backlog', netobj.name, count, channel)
+            netobj.call_hooks([netobj.sid, 'DISCORD_QUEUE_OVERFLOW', {'channel': channel.id, 'count': count}])
+            if self.serverdata.get('queue_overflow_notice', True):
+                netobj.call_hooks([netobj.sid, 'NOTICE', {'target': channel.id,
+                    'text': '%d message(s) from IRC could not be delivered to Discord in time and were dropped.' % count}])
+
+    def _buffer_message(self, joined_messages, message):
+        """
+        Adds a QueuedMessage to the message builder's buffer (channel -> lane -> deque of QueuedMessages).
+        Returns the deque that the message was added to.
+        """
+        message.text = irc_to_discord(message.text,
+                                      markdown=self.serverdata.get('irc_formatting', 'markdown') == 'markdown',
+                                      escape_markdown=self.serverdata.get('escape_markdown', True),
+                                      allow_mention_everyone=self.serverdata.get('allow_mention_everyone', False))
+        lanes = joined_messages.setdefault(message.channel, collections.OrderedDict())
+        messages = lanes.setdefault(message.lane, collections.deque())
+        messages.append(message)
+        return messages
+
+    def _message_builder(self):
+        """
+        Discord message queue handler. Also supports virtual users via webhooks.
+        """
+        joined_messages = {}
+        batch_start = None
+        while not self._aborted.is_set():
+            try:
+                try:
+                    # message is an instance of QueuedMessage (defined in this file)
+                    message = self.message_queue.get(timeout=BATCH_DELAY)
+                except queue.Empty:  # Process buffered messages together when we run out of things in the queue
+                    if joined_messages:
+                        self._flush_messages(joined_messages)
+                    elif self._queue_overflows:
+                        self._report_queue_overflows()
+                    if self.spool:  # Write out acks
+                        self.spool.sync()
+                    continue
 
                 # First, buffer messages by channel
-                joined_messages[message.channel].append(message)
-
-            except queue.Empty:  # Then process them together when we run out of things in the queue
-                for channel, messages in joined_messages.items():
-                    next_message = []
-                    length = 0
-                    current_sender = None
-                    # We group messages here to avoid being throttled as often. In short, we want to send a message when:
-                    # 1) The virtual sender (for webhook purposes) changes
-                    # 2) We reach the message limit for one batch (2000 chars)
-                    # 3) We run out of messages at the end
-                    while messages:
-                        message = messages.popleft()
-                        next_message.append(message.text)
-                        length += len(message.text)
-
-                        if message.sender != current_sender or length >= self.MAX_MESSAGE_SIZE:
-                            current_sender = message.sender
-                            _send(current_sender, channel, message.pylink_target, next_message)
-                            next_message.clear()
-                            length = 0
-
-                    # The last batch
-                    if next_message:
-                        _send(current_sender, channel, message.pylink_target, next_message)
-
-                joined_messages.clear()
+                if not joined_messages:
+                    batch_start = time.monotonic()
+                self._buffer_message(joined_messages, message)
+
+                # Don't let a steady stream of messages delay sending indefinitely
+                if time.monotonic() - batch_start >= MAX_BATCH_DELAY:
+                    self._flush_messages(joined_messages)
             except Exception:
                 log.exception("Exception in message queueing thread:")
 
@@ -1058,6 +2927,11 @@ class PyLinkDiscordProtocol(PyLinkNetworkCoreWithUtils):
         self._message_thread = threading.Thread(name="Messaging thread for %s" % self.name,
                                                 target=self._message_builder, daemon=True)
         self._message_thread.start()
+        self._open_spool()
+        self._start_http_server()
+        self._start_hub_monitor()
+        if len(self.senders) > 1:
+            gevent.spawn(self._init_senders)
         self.client.run()
 
     def disconnect(self):
@@ -1073,6 +2947,159 @@ class PyLinkDiscordProtocol(PyLinkNetworkCoreWithUtils):
         self.client.gw.shutting_down = True
         self.client.gw.ws.close()
 
+        if self._http_server:
+            self._http_server.stop()
+            self._http_server = None
+
+        # Anything still queued stays in the spool, to be sent on the next start
+        if self.spool:
+            self.spool.close()
+
         self._post_disconnect()
 
+_hub_monitor = None
+
+def _get_discord_network(irc, args):
+    """
+    Returns the Discord network object a command should act on: the one named in args, the parent of
+    the Discord guild the command was sent from, or the only Discord network loaded.
+    Replies with an error and returns None if none could be found.
+    """
+    if args:
+        netobj = world.networkobjects.get(args[0])
+        if netobj is None:
+            irc.error("Unknown network %r." % args[0])
+            return
+    else:
+        netobj = irc
+
+    if isinstance(netobj, DiscordServer):
+        return netobj.virtual_parent
+    elif isinstance(netobj, PyLinkDiscordProtocol):
+        return netobj
+
+    candidates = [nwobj for nwobj in world.networkobjects.values() if isinstance(nwobj, PyLinkDiscordProtocol)]
+    if len(candidates) == 1 and not args:
+        return candidates[0]
+    irc.error("Please specify a Discord network to use.")
+
+def discordmem(irc, source, args):
+    """[<network>]
+
+    Shows how many members, channels, and cached messages the Discord state cache holds for each guild."""
+    permissions.check_permissions(irc, source, ['discord.memstats'])
+    discord_netobj = _get_discord_network(irc, args)
+    if discord_netobj is None:
+        return
+
+    state = discord_netobj.client.state
+    for guild, stats in discord_netobj.get_memory_report():
+        irc.reply('\x02%s\x02 (%s): %s' % (guild.name, guild.id,
+                  ', '.join('%s=%s' % (k, v) for k, v in stats.items())), private=True)
+    irc.reply('Totals: users=%s, channels=%s, dms=%s, dm_cache=%s, webhooks=%s' % (
+              len(state.users), len(state.channels), len(state.dms),
+              len(discord_netobj.bot_plugin._dm_channels), len(discord_netobj.webhooks)), private=True)
+utils.add_cmd(discordmem, featured=True)
+
+def discordstats(irc, source, args):
+    """[<network>] [<metric prefix>]
+
+    Shows the metrics collected for the given Discord network: message queue depth, batch sizes and flush
+    times, REST calls and rate limits per route, webhook cache usage, and event handler times.
+    By default, this shows one total per metric. If a metric prefix (e.g. discord_http_) is given, every
+    label set of the matching metrics is sent in private instead."""
+    permissions.check_permissions(irc, source, ['discord.stats'])
+    args = list(args)
+    prefix = None
+    if args and args[-1].startswith('discord_'):
+        prefix = args.pop()
+    discord_netobj = _get_discord_network(irc, args)
+    if discord_netobj is None:
+        return
+
+    if prefix is None:
+        line = ''
+        for total in discord_netobj.metrics.totals():
+            if line and len(line) + len(total) > 350:
+                irc.reply(line)
+                line = ''
+            line = '%s, %s' % (line, total) if line else total
+        irc.reply(line or 'No metrics have been collected yet.')
+        return
+
+    lines = discord_netobj.metrics.summary(prefix)
+    if not lines:
+        irc.error('No metrics matching %r.' % prefix)
+        return
+    for line in lines:
+        irc.reply(line, private=True)
+utils.add_cmd(discordstats, featured=True)
+
+def discordblocking(irc, source, args):
+    """[<amount>]
+
+    Shows the call sites that blocked the gevent hub for the longest total time, if the hub block monitor
+    is enabled (block_monitor_threshold). Defaults to showing the top 10."""
+    permissions.check_permissions(irc, source, ['discord.stats'])
+    if _hub_monitor is None:
+        irc.error("The hub block monitor is not enabled. Set block_monitor_threshold to enable it.")
+        return
+    try:
+        amount = int(args[0]) if args else 10
+    except ValueError:
+        irc.error("Invalid amount %r." % args[0])
+        return
+
+    call_sites = sorted(_hub_monitor.call_sites.items(), key=lambda item: item[1][1], reverse=True)
+    if not call_sites:
+        irc.reply("The hub has not been blocked for longer than %.0f ms." % (_hub_monitor.threshold * 1000))
+        return
+    for call_site, (count, total, maximum, _) in call_sites[:amount]:
+        irc.reply('%s: blocked %d times, %.0f ms total, %.0f ms max' % (call_site, count, total * 1000, maximum * 1000),
+                  private=True)
+utils.add_cmd(discordblocking)
+
+_sampler = None
+def discordprofile(irc, source, args):
+    """start [<interval in ms>]|stop [<filename>]
+
+    Starts or stops the sampling profiler. When stopped, samples are written to the given filename
+    (in the current directory) in folded stack format, which can be turned into a flamegraph using tools
+    such as flamegraph.pl or speedscope."""
+    global _sampler
+    permissions.check_permissions(irc, source, ['discord.profile'])
+    try:
+        subcommand = args[0].lower()
+    except IndexError:
+        irc.error("Not enough arguments. Needs 1-2: start/stop, interval/filename (optional).")
+        return
+
+    if subcommand == 'start':
+        if _sampler and _sampler.running:
+            irc.error("The profiler is already running.")
+            return
+        try:
+            interval = float(args[1]) / 1000 if len(args) > 1 else 0.005
+        except ValueError:
+            irc.error("Invalid interval %r." % args[1])
+            return
+        _sampler = StackSampler(interval)
+        _sampler.start()
+        irc.reply("Profiler started (sampling every %.1f ms)." % (interval * 1000))
+
+    elif subcommand == 'stop':
+        if not (_sampler and _sampler.running):
+            irc.error("The profiler is not running.")
+            return
+        _sampler.stop()
+        # Don't allow writing outside the current directory
+        filename = os.path.basename(args[1]) if len(args) > 1 else \
+            'discord-profile-%d.folded' % time.time()
+        count = _sampler.dump(filename)
+        irc.reply("Profiler stopped; wrote %d samples to %s." % (count, filename))
+
+    else:
+        irc.error("Unknown subcommand %r (expected start or stop)." % subcommand)
+utils.add_cmd(discordprofile)
+
 Class = PyLinkDiscordProtocol
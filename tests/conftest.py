@@ -0,0 +1,26 @@
+import os
+import sys
+
+# The tests reuse the synthetic guilds and stubbed REST layer from the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import pytest
+
+import bench_discord
+
+@pytest.fixture
+def make_network():
+    """Returns a function creating BenchNetworks (see benchmarks/bench_discord.py), which are shut down afterwards."""
+    networks = []
+
+    def make(member_count=50, **serverdata):
+        # Only one network with the benchmark's name can exist at a time
+        while networks:
+            networks.pop().shutdown()
+        net = bench_discord.BenchNetwork(member_count, **serverdata)
+        networks.append(net)
+        return net
+
+    yield make
+    for net in networks:
+        net.shutdown()
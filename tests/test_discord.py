@@ -0,0 +1,447 @@
+import collections
+import json
+import queue
+import time
+
+import gevent
+import pytest
+import requests
+
+from pylinkirc import utils, world
+from pylinkirc.classes import User
+
+import bench_discord
+import synthetic
+
+discord = bench_discord.discord
+
+def add_relay_user(child, nick='ircuser'):
+    """Adds a user as relay would introduce them, and returns their UID."""
+    uid = '%s@test' % nick
+    user = child.users[uid] = User(child, nick=nick, ts=int(time.time()), uid=uid, server=child.sid)
+    user.remote = ('othernet', uid)
+    return uid
+
+def get_channel(net, child, idx=0):
+    return child.channels[int(synthetic.text_channels(net.guild_payload)[idx])].discord_channel
+
+def run_message_builder(net, lines, timeout=10):
+    """Runs the message builder until the stubbed REST layer received the given amount of lines."""
+    net.proto._aborted.clear()
+    builder = gevent.spawn(net.proto._message_builder)
+    deadline = time.monotonic() + timeout
+    try:
+        while net.transport.lines_delivered < lines and time.monotonic() < deadline:
+            gevent.sleep(0.01)
+    finally:
+        net.proto._aborted.set()
+        builder.join()
+
+@pytest.fixture
+def relay_clientbot():
+    """Forwards CLIENTBOT_MESSAGE hooks back to the network from the PyLink client, like relay_clientbot does."""
+    def forward(irc, source, command, args):
+        irc.message(irc.pseudoclient.uid, args['target'],
+                    '\x02[othernet]\x02 <%s> %s' % (irc.users[source].nick, args['text']))
+    utils.add_hook(forward, 'CLIENTBOT_MESSAGE')
+    yield
+    world.hooks['CLIENTBOT_MESSAGE'] = [pair for pair in world.hooks['CLIENTBOT_MESSAGE'] if pair[1] is not forward]
+
+@pytest.fixture
+def relayed_lines():
+    """Collects the text of PRIVMSG hooks, i.e. the lines relayed from Discord."""
+    lines = []
+    def collect(irc, source, command, args):
+        lines.append(args['text'])
+    utils.add_hook(collect, 'PRIVMSG')
+    yield lines
+    world.hooks['PRIVMSG'] = [pair for pair in world.hooks['PRIVMSG'] if pair[1] is not collect]
+
+def drain(message_queue):
+    """Returns the (channel, text) of each message left in the queue, in the order they come out."""
+    messages = []
+    while True:
+        try:
+            message = message_queue.get(timeout=0)
+        except queue.Empty:
+            return messages
+        messages.append((message.channel, message.text))
+
+def test_relayed_formatting_is_translated_once(make_network, relay_clientbot):
+    net = make_network()
+    child = net.burst()
+    channel = get_channel(net, child)
+
+    child.message(add_relay_user(child), channel.id, 'hello snake_case and \x02bold\x02 2*3')
+    run_message_builder(net, 1)
+    assert net.transport.delivered == ['**[othernet]** <ircuser> hello snake\\_case and **bold** 2\\*3']
+
+def test_relayed_events_are_queued_behind_replies(make_network):
+    net = make_network()
+    child = net.burst()
+    channel = get_channel(net, child)
+    uid = add_relay_user(child)
+
+    def forward_part(irc, source, command, args):
+        irc.message(irc.pseudoclient.uid, args['channel'], '-- %s has left' % irc.users[source].nick)
+    utils.add_hook(forward_part, 'CLIENTBOT_PART')
+    try:
+        child.call_hooks([uid, 'CLIENTBOT_PART', {'channel': channel.id, 'text': 'bye'}])
+    finally:
+        world.hooks['CLIENTBOT_PART'] = [pair for pair in world.hooks['CLIENTBOT_PART'] if pair[1] is not forward_part]
+    child.message(child.pseudoclient.uid, channel.id, 'command reply')
+
+    messages = [net.proto.message_queue.get(timeout=0) for _ in range(2)]
+    assert [(message.lane, message.text) for message in messages] == \
+        [('priority', 'command reply'), ('relay', '-- ircuser has left')]
+
+def test_queue_serves_lanes_in_order_and_channels_in_turn():
+    message_queue = discord.MessageQueue()
+    for channel, text, lane in [('a', 'a0', 'notice'), ('a', 'a1', 'relay'), ('a', 'a2', 'relay'),
+                                ('b', 'b0', 'relay'), ('b', 'b1', 'priority'), ('a', 'a3', 'relay')]:
+        message_queue.put_nowait(discord.QueuedMessage(channel, channel, text, lane=lane))
+
+    assert message_queue.lane_size('relay') == 4
+    assert message_queue.channel_size('a') == 4
+    assert [message.text for message in message_queue.channel_messages('a')] == ['a1', 'a2', 'a3', 'a0']
+    assert drain(message_queue) == [('b', 'b1'), ('a', 'a1'), ('b', 'b0'), ('a', 'a2'), ('a', 'a3'), ('a', 'a0')]
+
+def test_queue_get_can_exclude_channels():
+    message_queue = discord.MessageQueue()
+    for channel, text in [('a', 'a0'), ('b', 'b0'), ('b', 'b1')]:
+        message_queue.put_nowait(discord.QueuedMessage(channel, channel, text))
+
+    assert message_queue.get(timeout=0, exclude={('relay', 'a')}).text == 'b0'
+    assert message_queue.get(timeout=0, exclude={('relay', 'a')}).text == 'b1'
+    with pytest.raises(queue.Empty):
+        message_queue.get(timeout=0, exclude={('relay', 'a')})
+    assert drain(message_queue) == [('a', 'a0')]
+
+def test_flush_sends_one_batch_per_channel_per_turn(make_network):
+    net = make_network(use_webhooks=True, compact_backlog_threshold=0, compact_delay_threshold=0,
+                       compact_ratelimit_threshold=0)
+    child = net.burst()
+    busy, quiet = get_channel(net, child), get_channel(net, child, 1)
+    senders = [child.users[add_relay_user(child, nick)] for nick in ('ircuser', 'otheruser')]
+
+    joined_messages = {}
+    for idx in range(10):  # Every line is from another sender than the last, so each takes a webhook call
+        net.proto._buffer_message(joined_messages,
+                                  discord.QueuedMessage(busy, busy.id, 'busy %d' % idx, sender=senders[idx % 2]))
+    net.proto._buffer_message(joined_messages, discord.QueuedMessage(quiet, quiet.id, 'quiet', sender=senders[0]))
+    net.proto._flush_messages(joined_messages)
+
+    assert net.transport.delivered[:3] == ['busy 0', 'quiet', 'busy 1']
+    assert len(net.transport.delivered) == 11
+
+def test_queue_drops_oldest_per_channel():
+    overflows = []
+    message_queue = discord.MessageQueue(channel_maxsize=2, on_overflow=lambda *args: overflows.append(args))
+    for idx in range(3):
+        message_queue.put_nowait(discord.QueuedMessage('a', 'a', 'a%d' % idx))
+    message_queue.put_nowait(discord.QueuedMessage('b', 'b', 'b0'))
+
+    assert [(reason, [message.text for message in messages]) for reason, messages in overflows] == \
+        [('dropped', ['a0'])]
+    assert drain(message_queue) == [('a', 'a1'), ('b', 'b0'), ('a', 'a2')]
+
+def test_queue_drops_from_most_backlogged_channel_in_lowest_lane():
+    message_queue = discord.MessageQueue(maxsize=4)
+    message_queue.put_nowait(discord.QueuedMessage('a', 'a', 'a0', lane='priority'))
+    message_queue.put_nowait(discord.QueuedMessage('a', 'a', 'a1', lane='priority'))
+    message_queue.put_nowait(discord.QueuedMessage('c', 'c', 'c0'))
+    message_queue.put_nowait(discord.QueuedMessage('c', 'c', 'c1'))
+    message_queue.put_nowait(discord.QueuedMessage('b', 'b', 'b0'))
+
+    assert message_queue.qsize() == 4
+    assert drain(message_queue) == [('a', 'a0'), ('a', 'a1'), ('c', 'c1'), ('b', 'b0')]
+
+def test_queue_summarizes_dropped_messages():
+    message_queue = discord.MessageQueue(channel_maxsize=2, policy='summarize')
+    for idx in range(5):
+        message_queue.put_nowait(discord.QueuedMessage('a', 'a', 'a%d' % idx))
+
+    assert message_queue.channel_size('a') == 2  # The summary doesn't count
+    assert drain(message_queue) == [('a', '(3 older line(s) omitted due to backlog)'), ('a', 'a3'), ('a', 'a4')]
+
+@pytest.mark.parametrize('policy,expected', [('drop_oldest', [('a', 'a1')]),
+                                             ('summarize', [('a', '(1 older line(s) omitted due to backlog)'),
+                                                            ('a', 'a1')])])
+def test_queue_expires_old_messages(policy, expected):
+    overflows = []
+    message_queue = discord.MessageQueue(ttl=1, policy=policy, on_overflow=lambda *args: overflows.append(args))
+    old = discord.QueuedMessage('a', 'a', 'a0')
+    old.queued_at -= 2
+    message_queue.put_nowait(old)
+    message_queue.put_nowait(discord.QueuedMessage('a', 'a', 'a1'))
+
+    assert drain(message_queue) == expected
+    assert overflows == [('expired', [old])]
+
+def test_queue_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        discord.MessageQueue(policy='drop_newest')
+
+@pytest.mark.parametrize('reason,queue_options', [('dropped', {'message_queue_channel_size': 20}),
+                                                   ('expired', {'message_queue_ttl': 0.3})])
+def test_queue_bounds_apply_with_slow_transport(make_network, reason, queue_options):
+    net = make_network(use_webhooks=True, compact_backlog_threshold=0, compact_delay_threshold=0,
+                       compact_ratelimit_threshold=0, **queue_options)
+    net.transport.latency = 0.05
+    child = net.burst()
+    channel = get_channel(net, child)
+    uid = add_relay_user(child)
+
+    def produce():
+        for idx in range(400):  # 4 lines fit in one message, so this is faster than we can send
+            child.message(uid, channel.id, '%03d %s' % (idx, 'x' * 500))
+            gevent.sleep(0.005)
+
+    net.proto._aborted.clear()
+    builder = gevent.spawn(net.proto._message_builder)
+    producer = gevent.spawn(produce)
+    max_queued = 0
+    while not producer.dead or net.proto.message_queue.qsize():
+        max_queued = max(max_queued, net.proto.message_queue.qsize())
+        gevent.sleep(0.01)
+    net.proto._aborted.set()
+    builder.join()
+
+    removed = net.proto.metrics.get('discord_queue_overflow_total', reason=reason, lane='relay')
+    assert removed >= 100  # Most lines can't be sent in time
+    assert net.transport.lines_delivered + removed == 400
+    if 'message_queue_channel_size' in queue_options:
+        assert max_queued <= 20
+
+def test_forwarded_lines_stay_spooled_until_sent(make_network, relay_clientbot, tmp_path):
+    filename = str(tmp_path / 'spool.db')
+    net = make_network(spool=True, spool_file=filename)
+    net.proto._open_spool()
+    child = net.burst()
+    channel = get_channel(net, child)
+    spool = net.proto.spool
+
+    child.message(add_relay_user(child), channel.id, 'hello')
+    original = net.proto.message_queue.get(timeout=0)
+    net.proto._send_next_batch(channel, net.proto._buffer_message({}, original))
+    forwarded = net.proto.message_queue.get(timeout=0)
+    assert net.transport.delivered == []
+    assert forwarded.spool_id and list(spool.pending) == [forwarded.spool_id]
+    spool.sync()
+    assert [record['text'] for record in discord.MessageSpool(filename).open()] == ['hello']
+
+    net.proto._send_next_batch(channel, net.proto._buffer_message({}, forwarded))
+    assert net.transport.delivered == ['**[othernet]** <ircuser> hello']
+    assert not spool.pending
+
+def test_nick_index():
+    index = discord.NickIndex()
+    index.update(1, 'Alice', 'alice_')
+    index.update(2, None, 'bob')
+    assert index.lookup('ALICE') == index.lookup('alice_') == 1
+    assert index.lookup('Bob') == 2
+
+    index.update(1, 'Bob', 'alice_')  # Ambiguous names are not resolved
+    assert index.lookup('alice') is None
+    assert index.lookup('bob') is None
+    index.remove(2)
+    assert index.lookup('bob') == 1
+    assert len(index) == 1
+
+def test_nick_index_follows_member_events(make_network):
+    net = make_network()
+    child = net.burst()
+    member = net.guild_payload['members'][1]
+    uid = int(member['user']['id'])
+    assert child.nick_index.lookup(member['user']['username']) == uid
+
+    update = dict(synthetic.member_update(net.guild_payload, member, net.rng), nick='SomeNewNick')
+    net.plugin.on_member_update(net.dispatch('GUILD_MEMBER_UPDATE', update))
+    assert child.nick_index.lookup('somenewnick') == uid
+
+    net.plugin.on_member_remove(net.dispatch('GUILD_MEMBER_REMOVE', {'guild_id': net.guild_payload['id'],
+                                                                     'user': member['user']}))
+    assert child.nick_index.lookup('somenewnick') is None
+
+@pytest.mark.parametrize('text,expected', [
+    ('bob: hi', '<@42>: hi'),
+    ('bob, hi', '<@42>, hi'),
+    ('@Bob hi', '<@42> hi'),
+    ('@bob! hi', '<@42>! hi'),
+    ('\x02[othernet]\x02 <ircuser> bob: hi', '\x02[othernet]\x02 <ircuser> <@42>: hi'),
+    ('bobby: hi', 'bobby: hi'),
+    ('hi @bob', 'hi @bob'),
+    ('see https://mastodon.social/@bob', 'see https://mastodon.social/@bob'),
+    ('everyone: hi', 'everyone: hi'),
+])
+def test_resolve_mentions(make_network, text, expected):
+    net = make_network()
+    child = net.burst()
+    child.nick_index.update(42, 'Bob')
+    assert child._resolve_mentions(text) == expected
+
+def test_resolve_mentions_respects_allow_mention_everyone(make_network):
+    net = make_network()
+    child = net.burst()
+    assert child._resolve_mentions('everyone: meeting now', allow_mention_everyone=True) == '@everyone: meeting now'
+    assert child._resolve_mentions('Here, meeting now', allow_mention_everyone=True) == '@here, meeting now'
+
+@pytest.mark.parametrize('resolve_mentions,expected', [(None, 'bob: hi'), (True, '<@42>: hi')])
+def test_resolve_mentions_is_opt_in(make_network, resolve_mentions, expected):
+    net = make_network(**({} if resolve_mentions is None else {'resolve_mentions': resolve_mentions}))
+    child = net.burst()
+    child.nick_index.update(42, 'Bob')
+    child.message(child.pseudoclient.uid, get_channel(net, child).id, 'bob: hi')
+    assert net.proto.message_queue.get(timeout=0).text == expected
+
+def test_mention_renderer_cache_is_invalidated(make_network):
+    net = make_network()
+    child = net.burst()
+    member = net.guild_payload['members'][1]
+    role = net.guild_payload['roles'][1]
+    channel_id = synthetic.text_channels(net.guild_payload)[0]
+    content = 'hi <@%s> <@&%s> <#%s> <@123>' % (member['user']['id'], role['id'], channel_id)
+
+    def render():
+        payload = synthetic.message_create(net.guild_payload, channel_id, member, content, 10 ** 15)
+        return child.mention_renderer.render(net.dispatch('MESSAGE_CREATE', payload).message)
+
+    def update(event_type, payload, state_handler, plugin_handler):
+        event = net.dispatch(event_type, payload)
+        state_handler(event)
+        before = render()
+        plugin_handler(event)
+        return before, render()
+
+    channel = next(channel for channel in net.guild_payload['channels'] if channel['id'] == channel_id)
+    assert render() == 'hi @%s @%s #%s <@123>' % (member['nick'] or member['user']['username'], role['name'],
+                                                   channel['name'])
+
+    before, after = update('GUILD_MEMBER_UPDATE',
+                           dict(synthetic.member_update(net.guild_payload, member, net.rng), nick='newnick'),
+                           net.client.state.on_guild_member_update, net.plugin.on_member_update)
+    assert '@newnick' not in before  # Cached until the handler invalidates it
+    assert after.startswith('hi @newnick ')
+
+    before, after = update('GUILD_ROLE_UPDATE',
+                           {'guild_id': net.guild_payload['id'], 'role': dict(role, name='newrole')},
+                           net.client.state.on_guild_role_update, net.plugin.on_role_update)
+    assert '@newrole' not in before and '@newrole' in after
+
+    before, after = update('CHANNEL_UPDATE', dict(channel, guild_id=net.guild_payload['id'], name='newchannel'),
+                           net.client.state.on_channel_update, net.plugin.on_channel_update)
+    assert '#newchannel' not in before and '#newchannel' in after
+
+@pytest.mark.parametrize('edit_relay,expected', [('full', ['one', 'two', 'three']), ('changed', ['three'])])
+def test_message_edits(make_network, relayed_lines, edit_relay, expected):
+    net = make_network(edit_relay=edit_relay)
+    net.burst()
+    member = net.guild_payload['members'][1]
+    channel_id = synthetic.text_channels(net.guild_payload)[0]
+
+    def payload(content):
+        return synthetic.message_create(net.guild_payload, channel_id, member, content, 10 ** 15)
+
+    net.plugin.on_message(net.dispatch('MESSAGE_CREATE', payload('one\ntwo')))
+    assert relayed_lines == ['one', 'two']
+    del relayed_lines[:]
+
+    # Updates that don't change the text (e.g. pins or embeds being added) are dropped
+    net.plugin.on_message_update(net.dispatch('MESSAGE_UPDATE', payload('one\ntwo')))
+    assert relayed_lines == []
+    assert net.proto.metrics.get('discord_message_edits_total', result='unchanged') == 1
+
+    net.plugin.on_message_update(net.dispatch('MESSAGE_UPDATE', payload('one\ntwo\nthree')))
+    assert relayed_lines == expected
+
+@pytest.mark.parametrize('backlog_threshold,delay_threshold', [(10, 0), (2, 0), (0, 3), (3, 3)])
+def test_compact_mode_switches_back(make_network, monkeypatch, backlog_threshold, delay_threshold):
+    net = make_network(use_webhooks=True, compact_backlog_threshold=backlog_threshold,
+                       compact_delay_threshold=delay_threshold, compact_ratelimit_threshold=0)
+    child = net.burst()
+    channel = get_channel(net, child)
+    sender = child.users[add_relay_user(child)]
+    senders = [sender, child.users[add_relay_user(child, 'otheruser')]]
+
+    busy = collections.deque(discord.QueuedMessage(channel, channel.id, 'line %d' % idx, sender=senders[idx % 2])
+                             for idx in range(20))
+    for message in busy:  # Old enough to trigger the delay threshold
+        message.queued_at -= 10
+    assert net.proto._use_compact_mode(channel, busy)
+    assert net.proto._use_compact_mode(channel, busy)
+
+    monkeypatch.setattr(discord, 'COMPACT_MIN_DURATION', 0)
+    quiet = collections.deque([discord.QueuedMessage(channel, channel.id, 'hello', sender=sender)])
+    assert not net.proto._use_compact_mode(channel, quiet)
+    assert channel.id not in net.proto._compact_channels
+
+def test_inbound_shaping_is_off_by_default(make_network):
+    net = make_network()
+    child = net.burst()
+    lines = ['line %d' % idx for idx in range(50)]
+    assert net.plugin._shape_lines(child, get_channel(net, child).id, lines) == lines
+
+@pytest.mark.parametrize('max_lines,expected', [(3, ['line 0', 'line 1', '(3 more lines)']),
+                                                (4, ['line 0', 'line 1', 'line 2', '(2 more lines)']),
+                                                (5, ['line %d' % idx for idx in range(5)])])
+def test_inbound_summary_replaces_a_line(make_network, max_lines, expected):
+    net = make_network(inbound_max_lines=max_lines)
+    child = net.burst()
+    lines = ['line %d' % idx for idx in range(5)]
+    assert net.plugin._shape_lines(child, get_channel(net, child).id, lines) == expected
+
+class ForbiddenAPI:
+    """A sender account API that lacks permission to send to any channel."""
+    def __init__(self):
+        self.calls = 0
+
+    def channels_messages_create(self, *args, **kwargs):
+        self.calls += 1
+        response = requests.Response()
+        response.status_code = 403
+        response._content = json.dumps({'code': 50013, 'message': 'Missing Permissions'}).encode('utf-8')
+        raise discord.APIException(response)
+
+def test_failed_sender_falls_back_to_main_account(make_network):
+    net = make_network()
+    child = net.burst()
+    channel = get_channel(net, child)
+    sender = discord.SenderClient('sender1', ForbiddenAPI(), guild_ids={channel.guild_id})
+    net.proto.senders.append(sender)
+
+    for idx in range(4):
+        net.proto._send_batch(channel, [discord.QueuedMessage(channel, channel.id, 'line %d' % idx)])
+    assert net.transport.delivered == ['line %d' % idx for idx in range(4)]
+    assert sender.api.calls == 1
+    assert channel.id in sender.failed_channels
+    assert net.proto._get_sender(channel) is net.proto.senders[0]
+
+def test_paste_from_one_sender_keeps_webhooks(make_network):
+    net = make_network(use_webhooks=True)
+    child = net.burst()
+    channel = get_channel(net, child)
+    sender = child.users[add_relay_user(child)]
+
+    paste = collections.deque(discord.QueuedMessage(channel, channel.id, 'line %d' % idx, sender=sender)
+                              for idx in range(12))
+    assert not net.proto._use_compact_mode(channel, paste)
+    other = child.users[add_relay_user(child, 'otheruser')]
+    paste.append(discord.QueuedMessage(channel, channel.id, 'hello', sender=other))
+    assert not net.proto._use_compact_mode(channel, paste)
+
+def test_spool_skips_invalid_records(tmp_path):
+    filename = str(tmp_path / 'spool.db')
+    valid = {'op': 'enqueue', 'id': 'a-1', 'ts': time.time(), 'guild': 1, 'channel': 2, 'target': 2,
+             'nick': 'ircuser', 'text': 'hello'}
+    with open(filename, 'w') as f:
+        f.write(json.dumps(valid) + '\n')
+        for line in ('[1, 2]', '"text"', '{"op": "enqueue", "id": "a-2"}', '{"op": "ack", "ids": 5}',
+                     json.dumps(dict(valid, id='a-3', ts='yesterday')), '{"op": "enq'):
+            f.write(line + '\n')
+
+    spool = discord.MessageSpool(filename)
+    assert spool.open() == [valid]
+    spool.ack(['a-1'])
+    spool.close()
+    assert not spool.is_open
+    assert discord.MessageSpool(filename).open() == []